@@ -20,37 +20,47 @@
 #
 
 import sys,os,logging
-from scipy import cluster
 import numpy as nu
 from misc.utilities import argpartition, partition
+from imageUtil import getRuns
 
 
-def assignToAgents(v,agents,agentConfig,M,vert=None,horz=None,fixAgents=False,maxWidth=nu.inf):
-    data = nu.nonzero(v)[0]
-    if len(data) > 1:
-        candidates = [tuple(x) if len(x)==1 else (x[0],x[-1]) for x in 
-                      nu.split(data,nu.nonzero(nu.diff(data)>1)[0]+1)]
-    elif len(data) == 1:
-        candidates = [tuple(data)]
-    else:
+def assignToAgents(v,agents,agentConfig,M,vert=None,horz=None,fixAgents=False,maxWidth=nu.inf,
+                   runs=None):
+    """
+    Assign the runs of ink in v (a row or column of an image) to agents.
+    Instead of v, the runs may be passed as an (N, 2) array of their first
+    and last indices (as returned by getRuns).
+    """
+    if runs is None:
+        runs = getRuns(v)
+    if len(runs) == 0:
         return agents
+    # candidate i is the point xy0[i] if hasXy1[i] is False, and the pair
+    # of points (xy0[i],xy1[i]) otherwise
+    xy0 = nu.empty((len(runs),2),nu.float)
+    xy1 = nu.empty((len(runs),2),nu.float)
     if vert is not None:
-        
-        candidates = [[nu.array([vert,horz]) for horz in horzz] for horzz in candidates]
+        xy0[:,0] = vert
+        xy1[:,0] = vert
+        xy0[:,1] = runs[:,0]
+        xy1[:,1] = runs[:,1]
     elif horz is not None:
-        candidates = [[nu.array([vert,horz]) for vert in vertz] for vertz in candidates]
+        xy0[:,0] = runs[:,0]
+        xy1[:,0] = runs[:,1]
+        xy0[:,1] = horz
+        xy1[:,1] = horz
     else:
         log = logging.getLogger(__name__)
         log.critical('Need to specify vert or horz')
+    hasXy1 = runs[:,0] != runs[:,1]
     unadopted = []
     bids = None
     newagents =[]
     if len(agents) == 0:
-        unadopted.extend(range(len(candidates)))
+        unadopted.extend(range(len(runs)))
     else:
-        bids = nu.zeros((len(candidates),len(agents)))
-        for i,c in enumerate(candidates):
-            bids[i,:] = nu.array([nu.abs(a.bid(*c)) for a in agents])
+        bids = nu.abs(AgentArrays(agents).bids(xy0,xy1,hasXy1))
         sortedBets = nu.argsort(bids,1)
         cidx = nu.argsort(sortedBets[:,0])
         adopters = set([])
@@ -59,7 +69,7 @@ def assignToAgents(v,agents,agentConfig,M,vert=None,horz=None,fixAgents=False,ma
             bestBet = bids[i,bestBidder]
             bidderHas = bestBidder in adopters
             if bestBet <= agents[bestBidder].maxError and not bidderHas:
-                agents[bestBidder].award(*candidates[i])
+                agents[bestBidder].award(xy0[i],xy1[i] if hasXy1[i] else None)
                 adopters.add(bestBidder)
                 newagents.append(agents[bestBidder])
             else:
@@ -67,40 +77,65 @@ def assignToAgents(v,agents,agentConfig,M,vert=None,horz=None,fixAgents=False,ma
         newagents.extend([agents[x] for x in set(range(len(agents))).difference(adopters)])
     if not fixAgents:
         for i in unadopted:
-            if len(candidates[i]) == 1 or (len(candidates[i]) >1 and (candidates[i][-1][0]-candidates[i][0][0]) <= M/50.):
+            if not hasXy1[i] or xy1[i,0]-xy0[i,0] <= M/50.:
                 # only add an agent if we are on a small section
-                newagent = Agent(agentConfig,nu.mean(nu.array(candidates[i]),0))
+                newagent = Agent(agentConfig,(xy0[i]+xy1[i])/2.0)
                 newagents.append(newagent)
     
     r = partition(lambda x: x.tick(fixAgents),newagents)
     return r.get(True,[]),r.get(False,[])
 
-def mergeAgents(agents):
+def mergeAgents(agents,window=3):
+    """
+    Merge agents that track the same line. Agents are sorted by their
+    intercept, and each agent is only compared to the next window agents
+    in that order. Pairs within maxError of each other are joined into
+    groups, closest pairs first, as long as all members of the joined
+    group are within maxError of each other (complete linkage). Each group
+    is merged into its agent that comes first in agents.
+    """
     if len(agents) < 3:
         return agents,[]
-    newagents = []
     N = len(agents)
-    pdist = []
-    for i in range(N-1):
-        for j in range(i+1,N):
-            if agents[i].points.shape[0] < 2 or agents[j].points.shape[0] < 2:
-                pdist.append(agents[i].maxError+1)
+    maxError = agents[0].maxError
+    distances = {}
+    def distance(i,j):
+        if (i,j) not in distances:
+            if agents[i].getNrOfPoints() < 2 or agents[j].getNrOfPoints() < 2:
+                distances[i,j] = maxError+1
             else:
-                pdist.append(agents[i].mergeable(agents[j]))
-    pdist = nu.array(pdist)
-    l = cluster.hierarchy.complete(pdist)
-    c = cluster.hierarchy.fcluster(l,agents[0].maxError,criterion='distance')
-    idict = argpartition(lambda x: x[0], nu.column_stack((c,nu.arange(len(c)))))
+                distances[i,j] = agents[i].mergeable(agents[j])
+        return distances[i,j]
+    order = sorted(range(N),key=lambda i: agents[i].getIntercept())
+    pairs = []
+    for k,i in enumerate(order):
+        for j in order[k+1:k+1+window]:
+            i0,j0 = min(i,j),max(i,j)
+            d = distance(i0,j0)
+            if d <= maxError:
+                pairs.append((d,i0,j0))
+    pairs.sort()
+    group = range(N)
+    members = dict((i,[i]) for i in range(N))
+    for d,i,j in pairs:
+        gi,gj = group[i],group[j]
+        if gi == gj:
+            continue
+        if all(distance(min(a,b),max(a,b)) <= maxError
+               for a in members[gi] for b in members[gj]):
+            gi,gj = min(gi,gj),max(gi,gj)
+            for a in members[gj]:
+                group[a] = gi
+            members[gi].extend(members.pop(gj))
+    newagents = []
     died = []
-    for v in idict.values():
-        if len(v) == 1:
-            newagents.append(agents[v[0]])
-        else:
-            a = agents[v[0]]
-            for i in v[1:]:
-                a.merge(agents[i])
-            newagents.append(a)
-            died.extend(v[1:])
+    for g in sorted(members.keys()):
+        v = sorted(members[g])
+        a = agents[v[0]]
+        for i in v[1:]:
+            a.merge(agents[i])
+        newagents.append(a)
+        died.extend(v[1:])
     return newagents,died
 
 def tls(X):
@@ -112,6 +147,116 @@ def tls(X):
 def getError(x,a):
     return nu.sum(nu.dot(x,nu.array([nu.cos(a*nu.pi),-nu.sin(a*nu.pi)]).T)**2)**.5
 
+class PointMoments(object):
+    """
+    Running sums (count, sum, and sum of outer products) of a set of 2D
+    points, from which the mean, the total least squares angle (see tls),
+    and the error (see getError) of the points can be computed in constant
+    time. Points are accumulated relative to the first point, to avoid
+    loss of precision.
+
+    >>> X = nu.array([[3.,0.],[4.1,10.],[4.9,21.],[6.,29.],[7.2,41.]])
+    >>> m = PointMoments(X)
+    >>> abs(m.getAngle()-tls(X-nu.mean(X,0))) < 1e-10
+    True
+    >>> abs(m.getError(.01)-getError(X-nu.mean(X,0),.01)) < 1e-10
+    True
+    >>> m.add(nu.array([8.,50.]))
+    >>> X = nu.vstack((X,[8.,50.]))
+    >>> abs(m.getError(.01,X[0])-getError(X-X[0],.01)) < 1e-10
+    True
+    """
+    def __init__(self,points):
+        points = nu.asarray(points,nu.float).reshape((-1,2))
+        self.origin = points[0].copy()
+        d = points-self.origin
+        self.n = points.shape[0]
+        self.s = nu.sum(d,0)
+        self.ss = nu.dot(d.T,d)
+
+    def copy(self):
+        other = PointMoments.__new__(PointMoments)
+        other.origin = self.origin
+        other.n = self.n
+        other.s = self.s.copy()
+        other.ss = self.ss.copy()
+        return other
+
+    def add(self,xy):
+        d = nu.asarray(xy,nu.float)-self.origin
+        self.n += 1
+        self.s += d
+        self.ss += nu.outer(d,d)
+
+    def getMean(self):
+        return self.origin+self.s/self.n
+
+    def getScatter(self):
+        "the scatter matrix of the points around their mean"
+        m = self.s/self.n
+        return self.ss-self.n*nu.outer(m,m)
+
+    def getAngle(self):
+        # direction of the principal axis of the scatter matrix
+        c = self.getScatter()
+        return (.5*nu.arctan2(2*c[0,1],c[1,1]-c[0,0])/nu.pi)%1.0
+
+    def getError(self,a,center=None):
+        """equivalent to getError(points-center,a), where center defaults to
+        the mean of the points"""
+        u = nu.array([nu.cos(a*nu.pi),-nu.sin(a*nu.pi)])
+        e = nu.dot(u,nu.dot(self.getScatter(),u))
+        if center is not None:
+            e += self.n*nu.dot(self.getMean()-center,u)**2
+        return max(0,e)**.5
+
+
+def angleDistance(a,b):
+    return (a-b+.5)%1-.5
+
+def median3(a,b,c):
+    return nu.maximum(nu.minimum(a,b),nu.minimum(nu.maximum(a,b),c))
+
+class AgentArrays(object):
+    """
+    The state of a list of agents, stored as parallel arrays, for
+    computing the bids of all agents on many candidates at once
+    """
+    def __init__(self,agents):
+        self.mean = nu.array([a.mean for a in agents],nu.float)
+        self.angle = nu.array([a.angle for a in agents],nu.float)
+        self.targetAngle = nu.array([a.targetAngle for a in agents],nu.float)
+        self.maxAngleDev = nu.array([a.maxAngleDev for a in agents],nu.float)
+        self.maxError = nu.array([a.maxError for a in agents],nu.float)
+        self.nPoints = nu.array([a.getNrOfPoints() for a in agents])
+
+    def bids(self,xy0,xy1,hasXy1):
+        """
+        Return a (candidates x agents) array of bids, where candidate i is
+        the point xy0[i] if hasXy1[i] is False, and the pair of points
+        (xy0[i],xy1[i]) otherwise. Bid j of candidate i is equal to
+        agents[j].bid(xy0[i]) or agents[j].bid(xy0[i],xy1[i]).
+        """
+        d0 = xy0[:,nu.newaxis,:]-self.mean[nu.newaxis,:,:]
+        d1 = xy1[:,nu.newaxis,:]-self.mean[nu.newaxis,:,:]
+        xyp1 = nu.where(hasXy1[:,nu.newaxis,nu.newaxis],d1,d0)
+        # agents with only one point have no empirical angle yet; they bid
+        # with the angle closest to that of the candidate (see Agent.bid)
+        aa0 = angleDistance((nu.arctan2(d0[:,:,0],d0[:,:,1])/nu.pi+1)%1,self.targetAngle)
+        aa1 = angleDistance((nu.arctan2(xyp1[:,:,0],xyp1[:,:,1])/nu.pi+1)%1,self.targetAngle)
+        angle = nu.where(self.nPoints == 1,
+                         median3(self.targetAngle+aa0,self.targetAngle+aa1,self.angle),
+                         self.angle)
+        anglePen = nu.abs(self.angle-angle)
+        c = nu.cos(angle*nu.pi)
+        s = -nu.sin(angle*nu.pi)
+        error0 = d0[:,:,0]*c+d0[:,:,1]*s
+        error1 = d1[:,:,0]*c+d1[:,:,1]*s
+        pairBids = nu.where(nu.sign(error0) != nu.sign(error1),
+                            0.0,nu.minimum(nu.abs(error0),nu.abs(error1)))
+        bids = nu.where(hasXy1[:,nu.newaxis],pairBids,nu.abs(error0))+anglePen
+        tooSteep = nu.abs(angleDistance(angle,self.targetAngle)) > self.maxAngleDev
+        return nu.where(tooSteep,self.maxError+1,bids)
 
 class AgentConfig(object):
     def __init__(self,targetAngle=0,maxAngleDev=0,maxError=0,minScore=0,offset=0,yoffset=0):
@@ -156,8 +301,23 @@ class Agent(object):
     def __str__(self):
         return 'Agent: {id}; angle: {angle:0.4f} ({ta:0.4f}+{ad:0.4f}); error: {err:0.3f} age: {age}; npts: {pts}; score: {score}; mean: {mean}'\
             .format(id=self.id,err=self.error,angle=self.angle,ta=self.targetAngle,ad=self.angleDev,
-                    age=self.age,pts=self.points.shape[0],score=self.score,mean=self.getDrawMean())
+                    age=self.age,pts=self.getNrOfPoints(),score=self.score,mean=self.getDrawMean())
     
+    @property
+    def points(self):
+        if self._points is None:
+            self._points = nu.array(self.pointList).reshape((-1,2))
+        return self._points
+
+    @points.setter
+    def points(self,points):
+        self.pointList = list(points)
+        self._points = points
+        self.moments = PointMoments(points)
+
+    def getNrOfPoints(self):
+        return self.moments.n
+
     def getLineWidth(self):
         return self.lw
 
@@ -178,6 +338,11 @@ class Agent(object):
     def getDrawMean(self):
         return self.mean+self.aoffset
 
+    def getIntercept(self):
+        "get signed distance to the origin of the line through the agent's mean, at the target angle"
+        return nu.dot(self.getDrawMean(),nu.array([nu.cos(self.targetAngle*nu.pi),
+                                                   -nu.sin(self.targetAngle*nu.pi)]))
+
     def getMiddle(self,M):
         "get Vertical position of agent at the horizontal center of the page of width M" 
         x = self.mean[0]+(M/2.0-self.mean[1])*nu.tan(self.angle*nu.pi)
@@ -185,8 +350,8 @@ class Agent(object):
 
     def mergeable(self,other):
         if other.age > 1 and self.age > 1:
-            e0 = getError(other.getDrawPoints()-self.getDrawMean(),self.angle)/float(other.points.shape[0])
-            e1 = getError(self.getDrawPoints()-other.getDrawMean(),other.angle)/float(self.points.shape[0])
+            e0 = other.moments.getError(self.angle,self.getDrawMean()-other.aoffset)/float(other.getNrOfPoints())
+            e1 = self.moments.getError(other.angle,other.getDrawMean()-self.aoffset)/float(self.getNrOfPoints())
             return (e0+e1)/2.0
         else:
             return self.maxError+1
@@ -205,9 +370,9 @@ class Agent(object):
         self.points = nu.array(tuple(set([tuple(y) for y in 
                                           nu.vstack((self.points,other.getDrawPoints()-self.aoffset))])))
         self.lineWidth = self.lineWidth+other.lineWidth
-        self.mean = nu.mean(self.points,0)
-        self.angleDev = ((tls(self.points-self.mean)-self.targetAngle)+.5)%1-.5
-        self.error = getError(self.points-self.mean,self.angle)/self.points.shape[0]
+        self.mean = self.moments.getMean()
+        self.angleDev = ((self.moments.getAngle()-self.targetAngle)+.5)%1-.5
+        self.error = self.moments.getError(self.angle)/self.getNrOfPoints()
         self.age = max(self.age,other.age)
         self.score = self.score+other.score
         
@@ -292,16 +457,16 @@ class Agent(object):
         else:
             lw = 1.0
             xy = xy0
-        points = nu.vstack((self.points,xy))
-        mean = nu.mean(points,0)
-        tlsr = tls(points-mean)
-        angleDev = ((tlsr-self.targetAngle)+.5)%1-.5
-        error = getError(points-mean,angleDev+self.targetAngle)/points.shape[0]
-        return error,angleDev,mean,lw,points
+        moments = self.moments.copy()
+        moments.add(xy)
+        mean = moments.getMean()
+        angleDev = ((moments.getAngle()-self.targetAngle)+.5)%1-.5
+        error = moments.getError(angleDev+self.targetAngle)/moments.n
+        return error,angleDev,mean,lw,xy,moments
 
     def bid(self,xy0,xy1=None):
         # distance of xy0 to the current line (defined by self.angle)
-        if self.points.shape[0] == 1:
+        if self.getNrOfPoints() == 1:
             # we have no empirical angle yet
             # find the optimal angle (within maxAngleDev), and give the error respective to that
             if xy1 == None:
@@ -329,9 +494,31 @@ class Agent(object):
     def award(self,xy0,xy1=None):
         self.adopted = True
         
-        self.error,self.angleDev,self.mean,lw,self.points = self.preparePointAdd(xy0,xy1=xy1)
+        self.error,self.angleDev,self.mean,lw,xy,self.moments = self.preparePointAdd(xy0,xy1=xy1)
+        self.pointList.append(xy)
+        self._points = None
         self._addLineWidth(lw)
 
+def makeAgent(agentConfig,xy0,xy1):
+    """
+    Return an agent that has been awarded the pairs of points (xy0[i],
+    xy1[i]) (the ends of runs of ink of a line, one per row or column) at
+    once. Unlike award, this takes the middle of every pair as a point of
+    the line, so the runs should not be thicker than the line.
+    """
+    xy0 = nu.asarray(xy0,nu.float)
+    xy1 = nu.asarray(xy1,nu.float)
+    agent = Agent(agentConfig,xy0[0],xy1[0])
+    agent.points = (xy0+xy1)/2.0
+    agent.lineWidth = list(1+nu.sum((xy0-xy1)**2,1)**.5)
+    agent.lw = nu.median(agent.lineWidth)
+    agent.lwstd = nu.std(agent.lineWidth)
+    agent.mean = agent.moments.getMean()
+    agent.angleDev = ((agent.moments.getAngle()-agent.targetAngle)+.5)%1-.5
+    agent.error = agent.moments.getError(agent.angle)/agent.getNrOfPoints()
+    agent.age = agent.score = agent.getNrOfPoints()
+    return agent
+
 
 if __name__ == '__main__':
     pass
@@ -18,6 +18,7 @@
 #    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
 
 import os,logging
+from collections import OrderedDict
 import numpy as nu
 from PIL import ImageDraw,ImageFont,Image
 from imageUtil import getImageData, writeImageData, makeMask, normalize, jitterImageEdges,getPattern
@@ -26,10 +27,54 @@ from misc.utilities import makeColors
 def log():
     return logging.getLogger(__name__)
 
+fontFile = os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'fonts','Ubuntu-Title.ttf')
+
+_fonts = {}
+
+def getFont(size):
+    """Return the label font in the given size, loading it only once per
+    process
+    """
+    if size not in _fonts:
+        _fonts[size] = ImageFont.truetype(fontFile,size)
+    return _fonts[size]
+
+_textBitmaps = OrderedDict()
+maxTextBitmaps = 1000
+
+def getTextBitmap(text,size):
+    """Return the opacities (uint8) of text rendered in the label font in
+    the given size. The most recently used bitmaps are cached.
+    """
+    key = (text,size)
+    d = _textBitmaps.pop(key,None)
+    if d is None:
+        font = getFont(size)
+        im = Image.new('L', font.getsize(text), 255) # Create a blank image with the given size
+        draw = ImageDraw.Draw(im)
+        draw.text((0,0), text, font=font, fill=None) #Draw text
+        d = 255-nu.asarray(im,nu.uint8)
+        if len(_textBitmaps) >= maxTextBitmaps:
+            _textBitmaps.popitem(last=False)
+    _textBitmaps[key] = d
+    return d
+
+def blendPixels(pixels,color,alpha):
+    """Return pixels (a uint8 array with (r, g, b) along the last axis)
+    blended with color by alpha
+    """
+    f = pixels.astype(nu.float32)
+    f *= 1-alpha
+    f += alpha*nu.asarray(color,nu.float32)
+    nu.clip(f,0,255,out=f)
+    return f.astype(nu.uint8)
+
 class AgentPainter(object):
     def __init__(self,img):
-        self.img = nu.array((255-img,255-img,255-img))
-        self.imgOrig = nu.array((255-img,255-img,255-img))
+        # the image is kept (not copied) to reset the canvas
+        self.source = img
+        # the canvas, as a (rows, columns, (r, g, b)) array
+        self.img = self.imgOrig
         self.maxAgents = 300
         self.colors = makeColors(self.maxAgents)
         self.paintSlots = nu.zeros(self.maxAgents,nu.bool)
@@ -37,13 +82,12 @@ class AgentPainter(object):
 
     def writeImage(self,fn,absolute=False):
         #print(nu.min(img),nu.max(img))
-        self.img = self.img.astype(nu.uint8)
         if absolute:
             fn = fn
         else:
             fn = os.path.join('/tmp',os.path.splitext(os.path.basename(fn))[0]+'.png')
         log().info('Writing image to file: {0}'.format(fn))
-        writeImageData(fn,self.img.shape[1:],self.img[0,:,:],self.img[1,:,:],self.img[2,:,:])
+        writeImageData(fn,self.img.shape[:2],self.img[:,:,0],self.img[:,:,1],self.img[:,:,2])
 
     def isRegistered(self,agent):
         return self.agents.has_key(agent)
@@ -70,28 +114,55 @@ class AgentPainter(object):
         else:
             log().warn('Unknown agent\n')
         
+    @property
+    def imgOrig(self):
+        """A new canvas with only the image drawn on it
+        """
+        img = nu.empty(self.source.shape+(3,),nu.uint8)
+        img[...] = (255-self.source)[:,:,nu.newaxis]
+        return img
+
     def reset(self):
-        self.img = self.imgOrig.copy()
+        self.img = self.imgOrig
 
-    def drawText(self, text, pos, size=30, color=(100,100,100), alpha=.5):
-        font = ImageFont.truetype('./fonts/Ubuntu-Title.ttf', size)
-        size = font.getsize(text) # Returns the width and height of the given text, as a 2-tuple.
-        im = Image.new('L', size, 255) # Create a blank image with the given size
-        draw = ImageDraw.Draw(im)
-        draw.text((0,0), text, font=font, fill=None) #Draw text
-        d = 255-nu.array(im.getdata(),nu.uint8).reshape(size[::-1])
-        maxX = min(self.img.shape[1]-1,d.shape[0]+pos[0])-pos[0]
-        maxY = min(self.img.shape[2]-1,d.shape[1]+pos[1])-pos[1]
+    def blend(self,region,color,alpha=1):
+        """Blend the pixels of region, a view of (or a fancy index into)
+        the canvas, with color
+        """
+        self.img[region] = blendPixels(self.img[region],color,alpha)
+
+    def renderText(self, text, pos, size=30):
+        """Return the rows, columns and opacities of the pixels of text,
+        drawn at pos
+        """
+        d = getTextBitmap(text,size)
+        maxX = min(self.img.shape[0]-1,d.shape[0]+pos[0])-pos[0]
+        maxY = min(self.img.shape[1]-1,d.shape[1]+pos[1])-pos[1]
         d = d[:maxX,:maxY]
         xx,yy = nu.nonzero(d)
-        
         vv = d[xx,yy]/255.
-        xx += pos[0]
-        yy += pos[1]
-        alpha = vv*alpha
-        self.img[0,xx,yy] = ((1-alpha)*self.img[0,xx,yy] + alpha*color[0]).astype(nu.uint8)
-        self.img[1,xx,yy] = ((1-alpha)*self.img[1,xx,yy] + alpha*color[1]).astype(nu.uint8)
-        self.img[2,xx,yy] = ((1-alpha)*self.img[2,xx,yy] + alpha*color[2]).astype(nu.uint8)
+        return xx+pos[0],yy+pos[1],vv
+
+    def paintPixels(self,xx,yy,color,alpha):
+        """Blend the pixels at rows xx and columns yy with color, by a
+        separate alpha per pixel
+        """
+        alpha = alpha.reshape((-1,1))
+        self.img[xx,yy] = ((1-alpha)*self.img[xx,yy] + alpha*nu.asarray(color)).astype(nu.uint8)
+
+    def drawText(self, text, pos, size=30, color=(100,100,100), alpha=.5):
+        xx,yy,vv = self.renderText(text,pos,size)
+        self.paintPixels(xx,yy,color,vv*alpha)
+
+    def drawTexts(self, texts, positions, sizes, color=(100,100,100), alpha=.5):
+        """Draw many texts (at positions, with font sizes) in one pass;
+        where texts overlap, the pixels of the last one are kept
+        """
+        rendered = [self.renderText(text,pos,size) for text,pos,size in zip(texts,positions,sizes)]
+        if len(rendered) == 0:
+            return
+        xx,yy,vv = [nu.concatenate(x) for x in zip(*rendered)]
+        self.paintPixels(xx,yy,color,vv*alpha)
 
     def drawAgentGood(self,agent,rmin=-100,rmax=100):
         if self.agents.has_key(agent):
@@ -100,7 +171,7 @@ class AgentPainter(object):
             c = self.colors[self.agents[agent]]
             c1 = nu.minimum(255,c+50)
             c2 = nu.maximum(0,c-100)
-            M,N = self.img.shape[1:]
+            M,N = self.img.shape[:2]
             rng = nu.arange(rmin,rmax)
             xy = nu.round(nu.column_stack((rng*nu.sin(agent.angle*nu.pi)+agent.getDrawMean()[0],
                                            rng*nu.cos(agent.angle*nu.pi)+agent.getDrawMean()[1])))
@@ -132,7 +203,7 @@ class AgentPainter(object):
             c = self.colors[self.agents[agent]]
             c1 = nu.minimum(255,c+50)
             c2 = nu.maximum(0,c-100)
-            M,N = self.img.shape[1:]
+            M,N = self.img.shape[:2]
             #rng = nu.arange(rmin,rmax)
             rng = nu.arange(rmin,rmax,.95)
             xy = nu.round(nu.column_stack((rng*nu.sin(agent.angle*nu.pi)+agent.getDrawMean()[0],
@@ -167,47 +238,83 @@ class AgentPainter(object):
         self.paintRav(coords,color,alpha)
 
     def paintRav(self,coords,color,alpha=1):
-        idx = (self.img.shape[2]*nu.round(coords[:,0])+nu.round(coords[:,1])).astype(nu.int64)
-        self.img[0,:,:].flat[idx] = nu.minimum(255,nu.maximum(0,(1-alpha)*self.img[0,:,:].flat[idx]+alpha*color[0])).astype(nu.uint8)
-        self.img[1,:,:].flat[idx] = nu.minimum(255,nu.maximum(0,(1-alpha)*self.img[1,:,:].flat[idx]+alpha*color[1])).astype(nu.uint8)
-        self.img[2,:,:].flat[idx] = nu.minimum(255,nu.maximum(0,(1-alpha)*self.img[2,:,:].flat[idx]+alpha*color[2])).astype(nu.uint8)
+        idx = (self.img.shape[1]*nu.round(coords[:,0])+nu.round(coords[:,1])).astype(nu.int64)
+        pixels = self.img.reshape((-1,3))
+        pixels[idx] = blendPixels(pixels[idx],color,alpha)
 
     def paintRectangle(self,topleft,botright,color,alpha=1):
         x0,y0 = topleft
         x1,y1 = botright
-        self.img[0,x0:x1,y0:y1] = nu.minimum(255,nu.maximum(0,(1-alpha)*self.img[0,x0:x1,y0:y1]+alpha*color[0])).astype(nu.uint8)
-        self.img[1,x0:x1,y0:y1] = nu.minimum(255,nu.maximum(0,(1-alpha)*self.img[1,x0:x1,y0:y1]+alpha*color[1])).astype(nu.uint8)
-        self.img[2,x0:x1,y0:y1] = nu.minimum(255,nu.maximum(0,(1-alpha)*self.img[2,x0:x1,y0:y1]+alpha*color[2])).astype(nu.uint8)
+        self.blend((slice(x0,x1),slice(y0,y1)),color,alpha)
+
+    def paintRectangles(self,rectangles,colors,alpha=1,bandSize=256):
+        """
+        Paint many rectangles (rows of topleft and botright coordinates),
+        each with its own color, in a single blend. The opacity and the
+        color (times the opacity) of each pixel are painted into buffers,
+        and the pixels are then blended with them at once, as in
+        blendPixels; to bound the size of the buffers, this is done in
+        bands of bandSize rows. Where rectangles overlap, pixels are
+        blended only once, with the color of the last rectangle.
+        """
+        if len(rectangles) == 0:
+            return
+        M,N = self.img.shape[:2]
+        rectangles = nu.clip(nu.array(rectangles,nu.int).reshape((-1,4)),0,(M,N,M,N))
+        colors = alpha*nu.array(colors,nu.float32).reshape((-1,3))
+        valid = (rectangles[:,0] < rectangles[:,2]) & (rectangles[:,1] < rectangles[:,3])
+        rectangles,colors = rectangles[valid],colors[valid]
+        if len(rectangles) == 0:
+            return
+        left,right = nu.min(rectangles[:,1]),nu.max(rectangles[:,3])
+        # the bands cover the runs of rows that are covered by rectangles
+        depth = nu.zeros(M+1,nu.int)
+        nu.add.at(depth,rectangles[:,0],1)
+        nu.add.at(depth,rectangles[:,2],-1)
+        edges = nu.diff(nu.append(0,nu.cumsum(depth) > 0).astype(nu.int))
+        starts,ends = nu.nonzero(edges == 1)[0],nu.nonzero(edges == -1)[0]
+        bands = [(r0,min(r0+bandSize,end)) for start,end in zip(starts,ends)
+                 for r0 in range(start,end,bandSize)]
+        for r0,r1 in bands:
+            inBand = nu.nonzero((rectangles[:,0] < r1) & (rectangles[:,2] > r0))[0]
+            region = self.img[r0:r1,left:right]
+            keep = nu.ones(region.shape,nu.float32)
+            color = nu.zeros(region.shape,nu.float32)
+            for k in inBand:
+                x0,y0,x1,y1 = rectangles[k]-(r0,left,r0,left)
+                keep[max(0,x0):x1,y0:y1] = 1-alpha
+                # filling with a whole row is much faster than broadcasting
+                # the color over the rectangle
+                color[max(0,x0):x1,y0:y1] = nu.tile(colors[k],(y1-y0,1))
+            f = region.astype(nu.float32)
+            f *= keep
+            f += color
+            region[...] = f
 
     def paint(self,coord,color,alpha=1):
         #print('point',coord,img.shape)
-        self.img[:,int(coord[0]),int(coord[1])] = (1-alpha)*self.img[:,int(coord[0]),int(coord[1])]+alpha*color
+        self.img[int(coord[0]),int(coord[1]),:] = (1-alpha)*self.img[int(coord[0]),int(coord[1]),:]+alpha*color
 
     def paintVLine(self,y,alpha=.5,step=1,color=(100,0,100)):
-        if 0 <= y < self.img.shape[2]:
-            self.img[0,::step,y] = nu.minimum(255,nu.maximum(0,((1-alpha)*self.img[0,::step,y]+alpha*color[0]))).astype(nu.uint8)
-            self.img[1,::step,y] = nu.minimum(255,nu.maximum(0,((1-alpha)*self.img[1,::step,y]+alpha*color[1]))).astype(nu.uint8)
-            self.img[2,::step,y] = nu.minimum(255,nu.maximum(0,((1-alpha)*self.img[2,::step,y]+alpha*color[2]))).astype(nu.uint8)
+        if 0 <= y < self.img.shape[1]:
+            self.blend((slice(None,None,step),y),color,alpha)
 
     def paintHLine(self,x,alpha=.5,step=1,color=(0,255,255)):
-        if 0 <= x < self.img.shape[1]:
-            self.img[0,x,::step] = nu.minimum(255,nu.maximum(0,((1-alpha)*self.img[0,x,::step]+alpha*color[0]))).astype(nu.uint8)
-            self.img[1,x,::step] = nu.minimum(255,nu.maximum(0,((1-alpha)*self.img[1,x,::step]+alpha*color[1]))).astype(nu.uint8)
-            self.img[2,x,::step] = nu.minimum(255,nu.maximum(0,((1-alpha)*self.img[2,x,::step]+alpha*color[2]))).astype(nu.uint8)
+        if 0 <= x < self.img.shape[0]:
+            self.blend((x,slice(None,None,step)),color,alpha)
 
 
     def paintRect(self,xmin,xmax,ymin,ymax,color,alpha=.5):
         rectSize = 10
-        N,M = self.img.shape[1:]
+        N,M = self.img.shape[:2]
         t = int(max(0,xmin-nu.floor(rectSize/2.)))
         b = int(min(N-1,xmax+nu.floor(rectSize/2.)))
         l = int(max(0,ymin-nu.floor(rectSize/2.)))
         r = int(min(M-1,ymax+nu.floor(rectSize/2.)))
-        for i,c in enumerate(color):
-            self.img[i,t:b,l] = c
-            self.img[i,t:b,r] = c
-            self.img[i,t,l:r] = c
-            self.img[i,b,l:r+1] = c
+        self.img[t:b,l] = color
+        self.img[t:b,r] = color
+        self.img[t,l:r] = color
+        self.img[b,l:r+1] = color
 
 
 if __name__ == '__main__':
@@ -20,12 +20,25 @@
 import logging
 import numpy as nu
 from misc.utilities import cachedProperty
-from imageUtil import getAntiAliasedImg,findValleys,findPeaks,smooth,Rotator
+from imageUtil import getDerotatedImg,findValleys,findPeaks,smooth,Rotator
 from agentPainter import AgentPainter
 import scipy.stats
 
 logging.basicConfig(format='%(levelname)s: [%(name)s] %(message)s',level=logging.INFO)
 
+def getBoundingBoxes(cornerCoordinates):
+    """Return the bounding boxes of a bar, given the top and bottom points
+    of the bar lines (or system borders) that delimit its parts, as a
+    flat array of topleft and botright coordinates
+    """
+    cc = cornerCoordinates
+    bb = []
+    for i in range(0,len(cc),2):
+        topleft = cc[i][0,:].astype(nu.int)
+        botright = cc[i+1][1,:].astype(nu.int)
+        bb.append((topleft,botright))
+    return nu.array(bb).ravel()
+
 class Bar(object):
     def __init__(self,scoreImg,kl1,kl2):
         self.scoreImg = scoreImg
@@ -69,20 +82,16 @@ class Bar(object):
 
     @cachedProperty
     def boundingBoxes(self):
-        cc = self.cornerCoordinates
-        bb = []
-        for i in range(0,len(cc),2):
-            topleft = cc[i][0,:].astype(nu.int)
-            botright = cc[i+1][1,:].astype(nu.int)
-            bb.append((topleft,botright))
-        return nu.array(bb).ravel()
+        return getBoundingBoxes(self.cornerCoordinates)
 
     def drawAsRect(self,k=0,color=(100,100,100),alpha=.5):
         cc = self.boundingBoxes.reshape((-1,4))
         for c in cc:
             self.scoreImg.ap.paintRectangle(c[:2],c[2:],color,alpha)
             
-    def drawText(self,text,size=2,color=(100,100,100),alpha=.5,position='above'):
+    def getTextPosition(self,size=2,position='above'):
+        """Return the position and font size of a label for this bar
+        """
         #w = int(5*nu.mean([s.staffLineDistance for s in self.scoreImg.systems]))
         sld = self.scoreImg.systems[self.sys1].staffLineDistance
         w = int(3*sld)
@@ -91,7 +100,11 @@ class Bar(object):
             pos = nu.array([-w,w])+self.cornerCoordinates[0][0,:]
         else:
             pos = nu.array([w,w])+self.cornerCoordinates[0][1,:]-nu.array([w+textSize,0])/4.
-        self.scoreImg.ap.drawText(text,pos.astype(nu.int),size = textSize,color=color,alpha=alpha)
+        return pos.astype(nu.int),textSize
+
+    def drawText(self,text,size=2,color=(100,100,100),alpha=.5,position='above'):
+        pos,textSize = self.getTextPosition(size,position)
+        self.scoreImg.ap.drawText(text,pos,size = textSize,color=color,alpha=alpha)
         
     def draw(self,k=0,ptoggle=True):
         #b0 = self.getBBs()[0]
@@ -296,15 +309,14 @@ class BarCandidate(object):
     def estimatedType(self):
         """
         Estimate whether this candidate is a LEFT, MIDDLE, RIGHT or INVALID bar. It
-        takes into account all barcandidates on the page, and for that it depends on
+        takes into account all barcandidates on the page (through
+        ScoreImage.leftRightMedian), and for that it depends on
         self.approximateNeighbourhood (watch out for cyclic dependencies)
         """
         
         if self.approximateNeighbourhood == None:
             return None
-        lrmedian = nu.median(nu.array([x for y in [[bc.leftRightAbsDiffSums for bc in system.barCandidates
-                                                    if bc.approximateNeighbourhood != None] 
-                                       for system in self.system.scrImage.systems] for x in y]),0)
+        lrmedian = self.system.scrImage.leftRightMedian
         statistic = nu.array(self.leftRightAbsDiffSums)
         statistic[statistic != 0] /= lrmedian[statistic != 0]
         if statistic[0] < .5:
@@ -348,13 +360,33 @@ class BarCandidate(object):
         rr = int(nu.round(min(W,rl+w)))
         return self._leftRightAbsDiffSums((ll,lr,rl,rr))
 
+    def __getstate__(self):
+        """Return the state of the candidate without its system and its
+        neighbourhood images, to send it between processes (see
+        ScoreImage.findBarLines); the system must be set again after
+        unpickling
+        """
+        state = dict(self.__dict__)
+        for name in ('system','neighbourhood','approximateNeighbourhood'):
+            state.pop(name,None)
+        return state
+
     @cachedProperty
     def neighbourhood(self):
         return self.approximateNeighbourhood
 
+    def releaseImages(self):
+        """Discard the neighbourhood images. Note that the neighbourhood is
+        recomputed without the vertical correction of refine, so the
+        properties of a refined candidate that depend on it should be
+        computed first.
+        """
+        del self.neighbourhood
+        del self.approximateNeighbourhood
+
     @cachedProperty
     def approximateNeighbourhood(self):
-        return self._getNeighbourhood()
+        return self.system.scrImage.storeImage(self._getNeighbourhood())
 
     @cachedProperty
     def rotator(self):
@@ -394,9 +426,10 @@ class BarCandidate(object):
         self.rotator = Rotator(self.agent.angle-.5,middle,nu.array((0,0.)))
         hhalf = int(sysHeight*self.heightFactor/2.)
         whalf = int(1.8*self.system.staffLineDistance)
-        xx,yy = nu.mgrid[-hhalf:hhalf,-whalf:whalf]
-        xxr,yyr = self.rotator.derotate(xx,yy)
-        # check if derotated neighbourhood is inside image
+        rows,cols = nu.arange(-hhalf,hhalf),nu.arange(-whalf,whalf)
+        # check if derotated neighbourhood is inside image (the derotated
+        # coordinates are linear, so it suffices to check the corners)
+        xxr,yyr = self.rotator.derotate(rows[[0,-1]].reshape((-1,1)),cols[[0,-1]].reshape((1,-1)))
         minx,maxx,miny,maxy = nu.min(xxr),nu.max(xxr),nu.min(yyr),nu.max(yyr)
         M,N = self.system.correctedImgSegment.shape
         # leave a border of one pixel for antialiasing:
@@ -406,7 +439,7 @@ class BarCandidate(object):
                          'not fit inside system neighbourhood' \
                          ''.format(*self.system.rotator.derotate(middle.reshape((1,2)))[0,:].astype(nu.int)))
             return None
-        cimg = getAntiAliasedImg(self.system.correctedImgSegment,xxr,yyr)
+        cimg = getDerotatedImg(self.system.correctedImgSegment,self.rotator,rows,cols)
         return cimg
 
     @cachedProperty
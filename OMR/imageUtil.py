@@ -19,7 +19,7 @@
 #    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import sys,os,logging
+import sys,os,logging,tempfile
 from PIL import Image
 import numpy as nu
 from scipy import signal
@@ -71,6 +71,61 @@ class Rotator(object):
         return xx+self.og[0],yy+self.og[1]
 
 
+class ScratchFile(object):
+    """
+    A temporary file to which arrays can be moved, so that they are kept
+    as memory maps of the file, rather than in memory. The file has no
+    name in the directory, and its disk space is freed as soon as the
+    ScratchFile and all arrays stored in it are discarded.
+    """
+    def __init__(self,directory=None):
+        self.f = tempfile.TemporaryFile(dir=directory)
+        self.size = 0
+
+    def store(self,arr):
+        """Return a copy of arr that is backed by the scratch file
+        """
+        if arr is None or arr.size == 0:
+            return arr
+        arr = nu.ascontiguousarray(arr)
+        offset = self.size
+        self.size += arr.nbytes
+        m = nu.memmap(self.f,dtype=arr.dtype,mode='r+',offset=offset,shape=arr.shape)
+        m[...] = arr
+        return m.view(nu.ndarray)
+
+def getRuns(v):
+    """Return the first and last index of each run of nonzero values in
+    v, as an (N, 2) array
+    """
+    ink = nu.zeros(len(v)+2,nu.int8)
+    ink[1:-1] = v != 0
+    d = nu.diff(ink)
+    return nu.column_stack((nu.nonzero(d == 1)[0],nu.nonzero(d == -1)[0]-1))
+
+class RunIndex(object):
+    """
+    The runs of nonzero values in each of a number of lines (the rows of
+    a 2D array), extracted in one sweep. The runs of line i are an (N, 2)
+    array of their first and last indices (as returned by getRuns).
+    """
+    def __init__(self,lines):
+        lines = nu.asarray(lines)
+        ink = nu.zeros((lines.shape[0],lines.shape[1]+2),nu.int8)
+        ink[:,1:-1] = lines != 0
+        d = nu.diff(ink,axis=1)
+        # nonzero yields the starts (and ends) line by line, in order
+        line,start = nu.nonzero(d == 1)
+        end = nu.nonzero(d == -1)[1]-1
+        self.runs = nu.column_stack((start,end))
+        self.offsets = nu.searchsorted(line,nu.arange(lines.shape[0]+1))
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self,i):
+        return self.runs[self.offsets[i]:self.offsets[i+1]]
+
 def findBeginEnd(N,maxes,mins,margin=0):
     over = nu.where(maxes > N-margin)[0]
     under = nu.where(mins < margin)[0]
@@ -86,27 +141,126 @@ def trimCoordinates(shape,xx,yy,margin=0):
     yb,ye = findBeginEnd(shape[1],nu.max(yy,0),nu.min(yy,0),margin)
     return xx[xb:xe,yb:ye],yy[xb:xe,yb:ye]
 
-def getAntiAliasedImg(img,xx,yy,trim=True):
+def _antiAlias(img,xx,yy,out):
+    # the weight of each corner pixel is the mean of its weights along both
+    # axes; the sum is arranged such that it is exact for constant patches
+    xf = nu.floor(xx)
+    yf = nu.floor(yy)
+    wxc = (xx-xf).astype(nu.float32)
+    wyc = (yy-yf).astype(nu.float32)
+    # flat indices of the floor/ceil corners (ceil equals floor for
+    # integral coordinates)
+    iff = xf.astype(nu.intp)*img.shape[1]+yf.astype(nu.intp)
+    icf = iff+img.shape[1]*(wxc > 0)
+    ifc = iff+(wyc > 0)
+    icc = icf+(wyc > 0)
+    flat = img.ravel()
+    ff = flat.take(iff).astype(nu.float32)
+    fc = flat.take(ifc).astype(nu.float32)
+    cf = flat.take(icf).astype(nu.float32)
+    cc = flat.take(icc).astype(nu.float32)
+    acc = ff+fc
+    dx = cf+cc
+    dx -= acc
+    dy = fc+cc
+    dy -= ff
+    dy -= cf
+    acc += ff
+    acc += cf
+    dx *= wxc
+    dy *= wyc
+    acc += dx
+    acc += dy
+    acc /= 4
+    out[...] = acc
+
+def getAntiAliasedImg(img,xx,yy,trim=True,blockSize=256):
     #jitter = .001
     #xx += nu.random.normal(0,jitter,xx.shape)
     #yy += nu.random.normal(0,jitter,yy.shape)
     if trim:
         xx,yy = trimCoordinates(img.shape,xx,yy,margin=1)
+    img = nu.ascontiguousarray(img)
+    out = nu.empty(xx.shape,nu.uint8)
+    # interpolate in blocks of rows, to bound the size of the temporaries
+    for i in range(0,xx.shape[0],blockSize):
+        _antiAlias(img,xx[i:i+blockSize],yy[i:i+blockSize],out[i:i+blockSize])
+    return out
+
+def getDerotatedImg(img,rotator,rows,cols,trim=True,blockSize=256):
+    """
+    Return the anti-aliased image of img at the grid of rows and cols
+    (1D arrays of local coordinates), derotated by rotator. This is
+    equivalent to getAntiAliasedImg(img,*rotator.derotate(xx,yy)) where
+    xx,yy = nu.meshgrid(rows,cols,indexing='ij'), but the derotated
+    coordinates are computed a block of rows at a time, rather than for
+    the full grid at once.
+    """
+    rows = nu.asarray(rows).reshape((-1,1))
+    cols = nu.asarray(cols).reshape((1,-1))
+    if trim:
+        # the coordinates are linear in rows and cols, so the extremes of
+        # a row (column) are at its first and last column (row)
+        xx,yy = rotator.derotate(rows,cols[:,[0,-1]])
+        xb,xe = findBeginEnd(img.shape[0],nu.max(xx,1),nu.min(xx,1),margin=1)
+        xx,yy = rotator.derotate(rows[[0,-1]],cols)
+        yb,ye = findBeginEnd(img.shape[1],nu.max(yy,0),nu.min(yy,0),margin=1)
+        rows,cols = rows[xb:xe],cols[:,yb:ye]
+    img = nu.ascontiguousarray(img)
+    out = nu.empty((rows.shape[0],cols.shape[1]),nu.uint8)
+    for i in range(0,rows.shape[0],blockSize):
+        xx,yy = rotator.derotate(rows[i:i+blockSize],cols)
+        _antiAlias(img,xx,yy,out[i:i+blockSize])
+    return out
+
+def downsample(img,factor):
+    """Return img (uint8) reduced by an integer factor (at most 16) along
+    both axes, by averaging blocks of factor x factor pixels. Trailing
+    rows and columns that do not fill a block are dropped. Pixel (i,j) of
+    the result is centered at (i*factor+(factor-1)/2.,j*factor+(factor-1)/2.)
+    in img.
+    """
+    if factor == 1:
+        return img
+    H,W = img.shape[0]//factor,img.shape[1]//factor
+    blocks = img[:H*factor,:W*factor].reshape((H,factor,W,factor))
+    sums = nu.sum(nu.sum(blocks,axis=3,dtype=nu.uint16),axis=1,dtype=nu.uint16)
+    return (sums//(factor*factor)).astype(nu.uint8)
 
-    xf = nu.floor(xx).astype(nu.int)
-    xc = nu.ceil(xx).astype(nu.int)
-    yf = nu.floor(yy).astype(nu.int)
-    yc = nu.ceil(yy).astype(nu.int)
-
-    wxc = xx%1
-    wxf = 1-wxc
-    wyc = yy%1
-    wyf = 1-wyc
-
-    return (((wxf+wyf)*img[xf,yf] +
-	     (wxf+wyc)*img[xf,yc] +
-	     (wxc+wyf)*img[xc,yf] +
-	     (wxc+wyc)*img[xc,yc])/4.0).astype(nu.uint8)
+def refineLinePosition(img,point,direction,halfLength,maxShift):
+    """
+    Return point (row, column), moved perpendicular to the line through
+    point with the given direction (drow, dcolumn) onto the center of the
+    ink of that line in img. The line is sampled over halfLength pixels on
+    either side of point, and shifts of up to maxShift pixels are
+    considered. If no line stands out clearly, point is returned as is.
+    """
+    point = nu.asarray(point,nu.float)
+    d = nu.asarray(direction,nu.float)
+    d = d/nu.sum(d**2)**.5
+    n = nu.array((d[1],-d[0]))
+    t = nu.arange(-int(halfLength),int(halfLength)+1)
+    s = nu.arange(-int(maxShift),int(maxShift)+1)
+    pts = point+t.reshape((-1,1,1))*d+s.reshape((1,-1,1))*n
+    rows = nu.round(pts[:,:,0]).astype(nu.intp)
+    cols = nu.round(pts[:,:,1]).astype(nu.intp)
+    inside = (rows >= 0) & (rows < img.shape[0]) & (cols >= 0) & (cols < img.shape[1])
+    profile = nu.sum(nu.where(inside,img[rows*inside,cols*inside],0),0).astype(nu.float)
+    pmin,pmax = nu.min(profile),nu.max(profile)
+    if pmax-pmin < .5*255*len(t):
+        return point
+    # the center of mass of the contiguous part of the profile around its
+    # maximum that is above half of the maximum
+    above = profile > (pmin+pmax)/2.
+    k = nu.argmax(profile)
+    b = k
+    while b > 0 and above[b-1]:
+        b -= 1
+    e = k+1
+    while e < len(s) and above[e]:
+        e += 1
+    w = profile[b:e]-pmin
+    return point+n*nu.sum(w*s[b:e])/nu.sum(w)
 
 def smooth(x,k):
     return nu.convolve(x,signal.hanning(k),'same')
@@ -117,6 +271,38 @@ def findPeaks(x):
 def findValleys(x):
     return nu.where(nu.diff(nu.sign(nu.diff(x)))>0)[0]+1
 
+def getStaffCombs(img,nStrips=16,fillThreshold=.6,maxLag=None):
+    """
+    Look for the comb of staff lines in the row projections of nStrips
+    narrow vertical strips of img (where ink is nonzero): staff lines
+    fill (nearly) entire rows of a strip, at regular distances. The rows
+    of a strip that have ink in more than fillThreshold of their pixels
+    (regardless of how dark the ink is, so that light ink and thin lines
+    that are blurred by downsampling count as well) are autocorrelated,
+    and the prominence of the highest peak at lags up to maxLag
+    (default: a 40th of the height) over the lowest autocorrelation at
+    smaller lags is taken; solid blocks of ink (thick strokes, dark
+    borders) correlate at small lags, but give no prominent peaks.
+
+    Return the prominence of the peak (between 0 and 2) and its lag (the
+    staff line distance) for each strip.
+    """
+    H,W = img.shape
+    if maxLag is None:
+        maxLag = H//40
+    # every other strip of 2*nStrips strips
+    edges = nu.linspace(0,W,2*nStrips+1).astype(nu.int)
+    lines = nu.column_stack([nu.sum(img[:,a:b] > 0,1) > fillThreshold*(b-a)
+                             for a,b in zip(edges[1::2],edges[2::2])])
+    lines = lines-nu.mean(lines,0)
+    # zero padded, so that lags up to maxLag do not wrap around
+    n = 2**int(nu.ceil(nu.log2(H+maxLag+1)))
+    ac = nu.fft.irfft(nu.abs(nu.fft.rfft(lines,n,axis=0))**2,n,axis=0)[:maxLag+1]
+    ac /= nu.maximum(ac[0],1e-9)
+    prominence = ac[1:]-nu.minimum.accumulate(ac[1:],axis=0)
+    lags = nu.argmax(prominence,0)
+    return prominence[lags,nu.arange(nStrips)],lags+1
+
 def findPeaksOld(v):
     """find the peaks in a smooth curve
     """
@@ -190,6 +376,33 @@ def getImageData(filename):
     data = nu.array(imageFh.getdata(),nu.uint8).reshape(tuple(s))
     return data
 
+def getImageArray(imageFh):
+    """Return the pixel data of the PIL image imageFh as a uint8 array of
+    shape (rows, columns, channels). The data is taken from the decoded
+    image buffer directly, rather than from a python sequence of pixels,
+    so the returned array may be a read-only view of that buffer.
+    """
+    if imageFh.mode == '1':
+        # bilevel data has no byte-per-pixel buffer, let PIL expand it
+        imageFh = imageFh.convert('L')
+    # decode first: numpy hides decoding errors (e.g. of truncated files)
+    # behind a TypeError
+    imageFh.load()
+    data = nu.asarray(imageFh,nu.uint8)
+    if data.ndim == 2:
+        data = data.reshape(data.shape+(1,))
+    return data
+
+def greyscale(data):
+    """Average the channels of a (rows, columns, channels) uint8 array
+    into a (rows, columns) uint8 array, in integer arithmetic (this
+    truncates the average like casting the float average to uint8 does)
+    """
+    nch = data.shape[2]
+    if nch == 1:
+        return data[:,:,0]
+    return (nu.sum(data,axis=2,dtype=nu.uint16)//nch).astype(nu.uint8)
+
 def avgChannels(img):
     if img.shape[1] > 1:
         return nu.mean(img,axis=1)
@@ -204,11 +417,16 @@ def getPattern(filename,useMask=True,alphaAsMaskIfAvailable=True):
     assert imageFh.mode.startswith('L') or imageFh.mode.startswith('RGB') or imageFh.mode.startswith("1")
     s = tuple(reversed(imageFh.size))
 
-    fimg = nu.array(imageFh.getdata(),nu.uint8).reshape((s[0]*s[1],-1))
+    data = getImageArray(imageFh)
+    hasAlpha = imageFh.mode[-1] == 'A'
+
+    if not useMask:
+        return greyscale(data[:,:,:-1] if hasAlpha else data)
+
+    fimg = data.reshape((s[0]*s[1],-1))
 
     #nch = img.shape[1]
     nch = len(imageFh.mode)
-    hasAlpha = imageFh.mode[-1] == 'A'
 
     # get greyscale img info, averaging RGB channels if necessary
     if hasAlpha:
@@ -228,10 +446,77 @@ def getPattern(filename,useMask=True,alphaAsMaskIfAvailable=True):
             log.info('Pattern {0} has a trivial\nalpha-channel. Using standard masking procedure instead.\n'.format(filename))
             mask = makeMask(255-img.reshape(s)).reshape(img.shape)
 
-    if useMask:
-        return nu.array((127-img)*mask,nu.int8).reshape(s)
+    return nu.array((127-img)*mask,nu.int8).reshape(s)
+
+def getPackedBits(imageFh):
+    """Return the pixels of the bilevel (mode 1) PIL image imageFh packed
+    into bits, as a (rows, (columns+7)//8) uint8 array, and whether set
+    bits are black. Uncompressed data (like that of PBM files) is read
+    from the file as is, without decoding it to a byte per pixel.
+    Compressed data (like CCITT G4 data) is decoded by PIL, which holds
+    bilevel images at a byte per pixel, and is packed afterwards.
+    """
+    w,h = imageFh.size
+    rowBytes = (w+7)//8
+    tile = getattr(imageFh,'tile',None) or []
+    if len(tile) == 1 and tile[0][0] == 'raw' and tile[0][1] == (0,0,w,h) and getattr(imageFh,'filename',None):
+        args = tile[0][3] if isinstance(tile[0][3],tuple) else (tile[0][3],)
+        rawmode,stride,orientation = (args+(0,1))[:3]
+        if rawmode in ('1','1;I') and stride in (0,rowBytes) and orientation == 1:
+            with open(imageFh.filename,'rb') as f:
+                f.seek(tile[0][2])
+                bits = nu.fromfile(f,nu.uint8,h*rowBytes)
+            if len(bits) == h*rowBytes:
+                return bits.reshape((h,rowBytes)),rawmode == '1;I'
+    imageFh.load()
+    return nu.fromstring(imageFh.tobytes(),nu.uint8).reshape((h,rowBytes)),False
+
+def downsampleBits(bits,width,factor,blackIs1=True):
+    """Return the bilevel image of width columns packed in bits (as
+    returned by getPackedBits) as a greyscale uint8 image, reduced by an
+    integer factor (at most 16) like downsample does. The bits are
+    unpacked a band of rows at a time, so the image is never held at a
+    byte per pixel at full resolution.
+    """
+    H,W = bits.shape[0]//factor,width//factor
+    img = nu.empty((H,W),nu.uint8)
+    band = max(1,1024//factor)
+    for i in range(0,H,band):
+        n = min(band,H-i)
+        block = nu.unpackbits(bits[i*factor:(i+n)*factor],axis=1)[:,:W*factor]
+        counts = nu.sum(nu.sum(block.reshape((n,factor,W,factor)),axis=3,dtype=nu.uint16),axis=1,dtype=nu.uint16)
+        if blackIs1:
+            counts = factor*factor-counts
+        img[i:i+n] = (counts*255)//(factor*factor)
+    return img
+
+def getGreyscaleImage(imageFh,width=None):
+    """Return the PIL image (or image file) imageFh as a greyscale (rows,
+    columns) uint8 array, like getPattern(filename,False,False). If width
+    is not None, the image is resized to that width, keeping its aspect
+    ratio.
+    Most of the downscaling is done while decoding: JPEG images are
+    decoded at a reduced size, bilevel images are reduced from their
+    packed bits, and the remaining integer factor is taken by averaging
+    blocks of pixels, before resizing to width exactly.
+    """
+    if isinstance(imageFh,basestring):
+        imageFh = Image.open(imageFh)
+    w,h = imageFh.size
+    if width is not None and width < w and imageFh.format == 'JPEG':
+        imageFh.draft('L',(width,int(round(h*width/float(w)))))
+    assert imageFh.mode.startswith('L') or imageFh.mode.startswith('RGB') or imageFh.mode.startswith("1")
+    factor = 1 if width is None else min(16,max(1,imageFh.size[0]//width))
+    if imageFh.mode == '1':
+        bits,blackIs1 = getPackedBits(imageFh)
+        img = downsampleBits(bits,imageFh.size[0],factor,blackIs1)
     else:
-        return nu.array(img,nu.uint8).reshape(s)
+        data = getImageArray(imageFh)
+        img = downsample(greyscale(data[:,:,:-1] if imageFh.mode[-1] == 'A' else data),factor)
+    if width is not None and img.shape[1] != width:
+        height = int(round(h*width/float(w)))
+        img = nu.asarray(Image.fromarray(img).resize((width,height),Image.ANTIALIAS),nu.uint8)
+    return img
 
 def getImageAndMask(filename,useMask=True,alphaAsMaskIfAvailable=True):
     imageFh = Image.open(filename)
@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+
+#    Copyright 2012, Maarten Grachten.
+#
+#    This file is part of CPOMR.
+#
+#    CPOMR is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    CPOMR is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Reading the page images of (scanned) PDF files in process, without
+extracting them to image files first. A page of a PDF file is addressed
+by a page name: the filename followed by the page number (starting at 1)
+in brackets, e.g. 'score.pdf[3]'. The image of a page is its largest
+image XObject; pages without images are skipped.
+
+Supported image filters are FlateDecode (with or without PNG
+predictors), DCTDecode, CCITTFaxDecode, JPXDecode (if PIL supports
+it), ASCIIHexDecode and ASCII85Decode.
+"""
+
+import os, re, mmap, zlib, struct, logging
+from collections import OrderedDict
+from cStringIO import StringIO
+import numpy as nu
+from PIL import Image
+from imageUtil import getGreyscaleImage
+
+def log():
+    return logging.getLogger(__name__)
+
+class PdfError(IOError): pass
+
+class Name(str):
+    "a PDF name (as opposed to a string)"
+
+class Ref(tuple):
+    "a PDF reference to an indirect object (object number, generation)"
+
+class Stream(object):
+    "a PDF stream: its dictionary, and the position of its data in the file"
+    def __init__(self,dictionary,start):
+        self.dict = dictionary
+        self.start = start
+
+whitespace = '\x00\t\n\x0c\r '
+delimiters = '()<>[]{}/%'
+tokenRe = re.compile(r'[\x00\t\n\x0c\r ]*(?:%[^\r\n]*[\x00\t\n\x0c\r ]*)*'
+                     r'(<<|>>|[\[\]{}]|/[^\x00\t\n\x0c\r ()<>\[\]{}/%]*|\(|<[0-9A-Fa-f\x00\t\n\x0c\r ]*>'
+                     r'|[^\x00\t\n\x0c\r ()<>\[\]{}/%]+)')
+numberRe = re.compile(r'[+-]?(\d+\.?\d*|\.\d+)$')
+objRe = re.compile(r'(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+obj\b')
+refRe = re.compile(r'[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+R\b')
+nameEscapeRe = re.compile(r'#([0-9A-Fa-f]{2})')
+stringEscapes = {'n':'\n','r':'\r','t':'\t','b':'\b','f':'\f','(':'(',')':')','\\':'\\'}
+
+def parseString(data,pos):
+    """Parse the literal string starting after the '(' at pos, and return
+    it with the position after it
+    """
+    chars = []
+    depth = 1
+    while True:
+        c = data[pos]
+        pos += 1
+        if c == '\\':
+            c = data[pos]
+            pos += 1
+            if c in stringEscapes:
+                chars.append(stringEscapes[c])
+            elif c in '01234567':
+                octal = c
+                while len(octal) < 3 and data[pos] in '01234567':
+                    octal += data[pos]
+                    pos += 1
+                chars.append(chr(int(octal,8)%256))
+            elif c == '\r':
+                if data[pos] == '\n':
+                    pos += 1
+            elif c != '\n':
+                chars.append(c)
+            continue
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                return ''.join(chars),pos
+        chars.append(c)
+
+def parseObject(data,pos):
+    """Parse the PDF object at pos in data, and return it with the
+    position after it. Dictionaries become dicts (with str keys), arrays
+    lists, names Names, references Refs, strings strs, and numbers ints
+    or floats.
+    """
+    m = tokenRe.match(data,pos)
+    if m is None:
+        raise PdfError('Cannot parse PDF object at offset {0}'.format(pos))
+    token = m.group(1)
+    pos = m.end()
+    if token == '<<':
+        d = {}
+        while True:
+            m = tokenRe.match(data,pos)
+            if m is not None and m.group(1) == '>>':
+                return d,m.end()
+            key,pos = parseObject(data,pos)
+            if not isinstance(key,Name):
+                raise PdfError('Invalid PDF dictionary key at offset {0}'.format(pos))
+            d[key],pos = parseObject(data,pos)
+    if token == '[':
+        a = []
+        while True:
+            m = tokenRe.match(data,pos)
+            if m is not None and m.group(1) == ']':
+                return a,m.end()
+            x,pos = parseObject(data,pos)
+            a.append(x)
+    if token[0] == '/':
+        return Name(nameEscapeRe.sub(lambda x: chr(int(x.group(1),16)),token[1:])),pos
+    if token == '(':
+        return parseString(data,pos)
+    if token[0] == '<':
+        h = ''.join(token[1:-1].split())
+        return (h+'0'*(len(h)%2)).decode('hex'),pos
+    if numberRe.match(token):
+        if '.' in token:
+            return float(token),pos
+        # an integer may be the first part of a reference
+        m = refRe.match(data,pos)
+        if m is not None:
+            return Ref((int(token),int(m.group(1)))),m.end()
+        return int(token),pos
+    if token == 'true':
+        return True,pos
+    if token == 'false':
+        return False,pos
+    if token == 'null':
+        return None,pos
+    raise PdfError('Unexpected PDF token {0!r} at offset {1}'.format(token,pos))
+
+def getStreamStart(data,pos):
+    """If the object parsed up to pos is followed by stream data, return the
+    position of the data, otherwise None
+    """
+    m = tokenRe.match(data,pos)
+    if m is None or m.group(1) != 'stream':
+        return None
+    pos = m.end()
+    if data[pos:pos+2] == '\r\n':
+        return pos+2
+    return pos+1
+
+class PdfFile(object):
+    """
+    The objects and page images of a PDF file. The objects are found by
+    scanning the file (skipping stream data), rather than through the
+    cross reference table, so damaged files can be read as well.
+    """
+    def __init__(self,fn):
+        self.fn = fn
+        with open(fn,'rb') as f:
+            self.data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        # object number -> (generation, offset) of the objects in the file
+        self.offsets = {}
+        self.objects = {}
+        self.trailers = []
+        self.objectStreamsRead = False
+        self._scan()
+
+    def _scan(self):
+        data = self.data
+        pos = 0
+        while True:
+            m = objRe.search(data,pos)
+            if m is None:
+                break
+            pos = m.end()
+            num,gen = int(m.group(1)),int(m.group(2))
+            try:
+                obj,end = parseObject(data,pos)
+            except (PdfError,IndexError,ValueError):
+                continue
+            self.offsets[num] = (gen,pos)
+            start = getStreamStart(data,end)
+            pos = end
+            if start is not None:
+                length = obj.get('Length')
+                if isinstance(length,int) and data[start+length:start+length+30].find('endstream') >= 0:
+                    pos = start+length
+                else:
+                    end = data.find('endstream',start)
+                    pos = start if end < 0 else end
+                if obj.get('Type') == 'XRef':
+                    self.trailers.append(obj)
+        pos = 0
+        while True:
+            pos = data.find('trailer',pos)
+            if pos < 0:
+                break
+            pos += len('trailer')
+            try:
+                self.trailers.append(parseObject(data,pos)[0])
+            except (PdfError,IndexError,ValueError):
+                pass
+
+    def _readObjectStreams(self):
+        """Add the objects stored in object streams to the objects"""
+        self.objectStreamsRead = True
+        for num in list(self.offsets.keys()):
+            obj = self.getObject(num)
+            if not (isinstance(obj,Stream) and obj.dict.get('Type') == 'ObjStm'):
+                continue
+            data = self.getStreamData(obj)
+            n,first = self.resolve(obj.dict['N']),self.resolve(obj.dict['First'])
+            header = data[:first].split()
+            for i in range(n):
+                objNum,offset = int(header[2*i]),int(header[2*i+1])
+                if objNum not in self.offsets and objNum not in self.objects:
+                    self.objects[objNum] = parseObject(data,first+offset)[0]
+
+    def getObject(self,num):
+        if num not in self.objects:
+            if num in self.offsets:
+                obj,end = parseObject(self.data,self.offsets[num][1])
+                start = getStreamStart(self.data,end)
+                self.objects[num] = obj if start is None else Stream(obj,start)
+            elif not self.objectStreamsRead:
+                self._readObjectStreams()
+                return self.getObject(num)
+            else:
+                self.objects[num] = None
+        return self.objects[num]
+
+    def resolve(self,obj):
+        while isinstance(obj,Ref):
+            obj = self.getObject(obj[0])
+        return obj
+
+    def getStreamData(self,stream,decode=True):
+        """Return the data of stream; if decode is True, the filters that
+        yield raw samples (all but the image compression filters) are
+        undone. The remaining filters are returned as well.
+        """
+        length = self.resolve(stream.dict.get('Length'))
+        if not isinstance(length,int):
+            end = self.data.find('endstream',stream.start)
+            length = end-stream.start
+        data = self.data[stream.start:stream.start+length]
+        filters = self.resolve(stream.dict.get('Filter',[]))
+        params = self.resolve(stream.dict.get('DecodeParms',[]))
+        if not isinstance(filters,list):
+            filters,params = [filters],[params]
+        if not isinstance(params,list):
+            params = [params]
+        filters = [self.resolve(f) for f in filters]
+        params = [self.resolve(p) or {} for p in params]+[{}]*(len(filters)-len(params))
+        while decode and len(filters) > 0:
+            f,p = filters[0],params[0]
+            if f in ('ASCIIHexDecode','AHx'):
+                h = ''.join(data.split('>')[0].split())
+                data = (h+'0'*(len(h)%2)).decode('hex')
+            elif f in ('ASCII85Decode','A85'):
+                data = decodeASCII85(data)
+            elif f in ('FlateDecode','Fl') and p.get('Predictor',1) == 1:
+                data = zlib.decompressobj().decompress(data)
+            else:
+                break
+            filters,params = filters[1:],params[1:]
+        return data,filters,params
+
+    def getRoot(self):
+        for trailer in reversed(self.trailers):
+            root = self.resolve(trailer.get('Root'))
+            if isinstance(root,dict):
+                return root
+        for num in self.offsets:
+            obj = self.getObject(num)
+            if isinstance(obj,dict) and obj.get('Type') == 'Catalog':
+                return obj
+        raise PdfError('Cannot find the document catalog of {0}'.format(self.fn))
+
+    def iterPages(self,node=None,resources=None,seen=None):
+        """Yield the page dictionaries, in page order, with their
+        (inherited) resources
+        """
+        if node is None:
+            node = self.resolve(self.getRoot().get('Pages'))
+            seen = set()
+        if not isinstance(node,dict) or id(node) in seen:
+            return
+        seen.add(id(node))
+        resources = self.resolve(node.get('Resources',resources))
+        if 'Kids' in node:
+            for kid in self.resolve(node['Kids']):
+                for page in self.iterPages(self.resolve(kid),resources,seen):
+                    yield page
+        else:
+            yield node,resources
+
+    def getImages(self,resources,depth=0):
+        """Return the image XObjects of resources (including those of the
+        form XObjects in it)
+        """
+        images = []
+        if not isinstance(resources,dict) or depth > 3:
+            return images
+        xobjects = self.resolve(resources.get('XObject',{}))
+        for ref in xobjects.values():
+            xobject = self.resolve(ref)
+            if not isinstance(xobject,Stream):
+                continue
+            subtype = xobject.dict.get('Subtype')
+            if subtype == 'Image':
+                images.append(xobject)
+            elif subtype == 'Form':
+                images.extend(self.getImages(self.resolve(xobject.dict.get('Resources')),depth+1))
+        return images
+
+    @property
+    def pageImages(self):
+        """The page number and image XObject of each page that has an
+        image, in page order
+        """
+        if not hasattr(self,'_pageImages'):
+            self._pageImages = OrderedDict()
+            for i,(page,resources) in enumerate(self.iterPages()):
+                images = self.getImages(resources)
+                if len(images) == 0:
+                    log().info('Page {0} of {1} has no images, skipping it'.format(i+1,self.fn))
+                    continue
+                self._pageImages[i+1] = max(images,key=lambda x: (self.resolve(x.dict.get('Width',0))*
+                                                                  self.resolve(x.dict.get('Height',0))))
+        return self._pageImages
+
+    def getImageData(self,pageNr):
+        """Return the (undecoded) data of the image of page pageNr"""
+        stream = self.pageImages[pageNr]
+        return self.getStreamData(stream,decode=False)[0]
+
+    def getImage(self,pageNr,width=None):
+        """Return the image of page pageNr as a PIL image; if width is not
+        None, JPEG images are decoded at a reduced size of at least width
+        """
+        stream = self.pageImages[pageNr]
+        return decodeImage(self,stream,width)
+
+def decodeASCII85(data):
+    data = ''.join(data.split('~>')[0].split())
+    if data.startswith('<~'):
+        data = data[2:]
+    out = []
+    group = []
+    for c in data:
+        if c == 'z' and len(group) == 0:
+            out.append('\0\0\0\0')
+            continue
+        group.append(ord(c)-33)
+        if len(group) == 5:
+            n = reduce(lambda a,b: a*85+b,group)
+            out.append(struct.pack('>I',n))
+            group = []
+    if len(group) > 0:
+        k = len(group)
+        n = reduce(lambda a,b: a*85+b,group+[84]*(5-k))
+        out.append(struct.pack('>I',n)[:k-1])
+    return ''.join(out)
+
+def makeTIFF(data,width,height,params):
+    """Return a TIFF file (a string) with the CCITT encoded data of an
+    image of width by height
+    """
+    k = params.get('K',0)
+    compression = 4 if k < 0 else 3
+    # CCITT data codes white runs as zeros; BlackIs1 tells whether black
+    # is 1 in the decoded image
+    photometric = 1 if params.get('BlackIs1',False) else 0
+    t4Options = (1 if k > 0 else 0)|(4 if params.get('EncodedByteAlign',False) else 0)
+    tags = [(256,4,width),(257,4,height),(258,3,1),(259,3,compression),(262,3,photometric),
+            (273,4,0),(277,3,1),(278,4,height),(279,4,len(data))]
+    tags.append((292,4,t4Options) if compression == 3 else (293,4,0))
+    headerSize = 8+2+12*len(tags)+4
+    entries = []
+    for tag,kind,value in tags:
+        if tag == 273:
+            value = headerSize
+        if kind == 3:
+            entries.append(struct.pack('<HHIHH',tag,kind,1,value,0))
+        else:
+            entries.append(struct.pack('<HHII',tag,kind,1,value))
+    return ''.join(['II*\0',struct.pack('<I',8),struct.pack('<H',len(tags))]+
+                   entries+[struct.pack('<I',0),data])
+
+def makePNG(data,width,height,bits,colors):
+    """Return a PNG file (a string) with the zlib compressed, PNG-filtered
+    scanlines in data
+    """
+    def chunk(kind,content):
+        return struct.pack('>I',len(content))+kind+content+\
+            struct.pack('>I',zlib.crc32(kind+content) & 0xffffffff)
+    colorType = {1:0,2:4,3:2,4:6}[colors]
+    ihdr = struct.pack('>IIBBBBB',width,height,bits,colorType,0,0,0)
+    return '\x89PNG\r\n\x1a\n'+chunk('IHDR',ihdr)+chunk('IDAT',data)+chunk('IEND','')
+
+def getComponents(pdf,colorSpace):
+    """Return the number of color components of colorSpace, and the color
+    table if it is an indexed color space
+    """
+    colorSpace = pdf.resolve(colorSpace)
+    if isinstance(colorSpace,list):
+        kind = pdf.resolve(colorSpace[0])
+        if kind in ('Indexed','I'):
+            n = getComponents(pdf,colorSpace[1])[0]
+            lookup = pdf.resolve(colorSpace[3])
+            if isinstance(lookup,Stream):
+                lookup = pdf.getStreamData(lookup)[0]
+            return 1,nu.fromstring(lookup,nu.uint8)[:(len(lookup)//n)*n].reshape((-1,n))
+        if kind == 'ICCBased':
+            return pdf.resolve(pdf.resolve(colorSpace[1]).dict.get('N',3)),None
+        if kind in ('CalRGB','Lab'):
+            return 3,None
+        if kind in ('Separation','DeviceN'):
+            return (1 if kind == 'Separation' else len(pdf.resolve(colorSpace[1]))),None
+        return getComponents(pdf,kind)
+    return {'DeviceRGB':3,'RGB':3,'CalRGB':3,'DeviceCMYK':4,'CMYK':4}.get(colorSpace,1),None
+
+def toGrey(samples,lookup=None):
+    """Return a (rows, columns) uint8 grey image of the uint8 samples, an
+    array of (rows, columns, components)
+    """
+    if lookup is not None:
+        samples = lookup[nu.minimum(samples[:,:,0],len(lookup)-1)]
+    n = samples.shape[2]
+    if n == 4:
+        # CMYK
+        ink = nu.sum(samples[:,:,:3],2,dtype=nu.uint16)//3+samples[:,:,3]
+        return (255-nu.minimum(ink,255)).astype(nu.uint8)
+    if n > 1:
+        return (nu.sum(samples[:,:,:3],2,dtype=nu.uint16)//3).astype(nu.uint8)
+    return samples[:,:,0]
+
+def decodeImage(pdf,stream,width=None):
+    """Return the image XObject stream of pdf as a PIL image (mode L or
+    1); if width is not None, JPEG images are decoded at a reduced size
+    of at least width
+    """
+    d = dict((k,pdf.resolve(v)) for k,v in stream.dict.items())
+    data,filters,params = pdf.getStreamData(stream)
+    w,h = d['Width'],d['Height']
+    invert = d.get('Decode',[0])[0] == 1
+    if d.get('ImageMask',False):
+        bits,colors,lookup = 1,1,None
+    else:
+        bits = d.get('BitsPerComponent',8)
+        colors,lookup = getComponents(pdf,d.get('ColorSpace','DeviceGray'))
+    if len(filters) > 1:
+        raise PdfError('Unsupported filters {0} in {1}'.format(filters,pdf.fn))
+    f = filters[0] if len(filters) > 0 else None
+    p = params[0] if len(params) > 0 else {}
+    if f in ('DCTDecode','DCT','JPXDecode'):
+        im = Image.open(StringIO(data))
+        if width is not None and f != 'JPXDecode':
+            # let the JPEG decoder do (part of) the downscaling
+            im.draft('L',(width,int(round(h*width/float(w)))))
+        if im.mode == 'CMYK':
+            samples = nu.asarray(im,nu.uint8)
+            if 'Adobe' in im.info or im.info.get('adobe') is not None:
+                samples = 255-samples
+            im = Image.fromarray(toGrey(samples))
+        elif im.mode != 'L':
+            im = im.convert('L')
+    elif f in ('CCITTFaxDecode','CCF'):
+        cols = p.get('Columns',1728)
+        rows = p.get('Rows',h) or h
+        im = Image.open(StringIO(makeTIFF(data,cols,rows,p)))
+        im.load()
+        if (cols,rows) != (w,h):
+            im = im.crop((0,0,w,h))
+    elif f in ('FlateDecode','Fl') or f is None:
+        if f is not None:
+            predictor = p.get('Predictor',1)
+            if predictor < 10:
+                raise PdfError('Unsupported TIFF predictor in {0}'.format(pdf.fn))
+            colors = p.get('Colors',colors)
+            bits = p.get('BitsPerComponent',bits)
+            w = p.get('Columns',w)
+            im = Image.open(StringIO(makePNG(data,w,h,bits,colors)))
+            im.load()
+            if bits == 1 and lookup is None and colors == 1:
+                im = im.convert('1')
+            else:
+                samples = nu.asarray(im,nu.uint8).reshape((h,w,-1))
+                if bits < 8 and lookup is None:
+                    samples = samples*(255//(2**bits-1))
+                im = Image.fromarray(toGrey(samples,lookup))
+        elif bits == 1 and colors == 1 and lookup is None:
+            im = Image.frombytes('1',(w,h),data)
+        elif bits == 8:
+            samples = nu.fromstring(data[:w*h*colors],nu.uint8).reshape((h,w,colors))
+            im = Image.fromarray(toGrey(samples,lookup))
+        elif bits in (2,4,16):
+            rowBytes = (w*colors*bits+7)//8
+            raw = nu.fromstring(data[:h*rowBytes],nu.uint8).reshape((h,rowBytes))
+            if bits == 16:
+                samples = raw[:,::2]
+            else:
+                bitsArr = nu.unpackbits(raw,axis=1)[:,:w*colors*bits].reshape((h,-1,bits))
+                samples = nu.dot(bitsArr,2**nu.arange(bits-1,-1,-1)).astype(nu.uint8)
+                if lookup is None:
+                    samples *= 255//(2**bits-1)
+            im = Image.fromarray(toGrey(samples.reshape((h,w,colors)),lookup))
+        else:
+            raise PdfError('Unsupported number of bits per component ({0}) in {1}'.format(bits,pdf.fn))
+    else:
+        raise PdfError('Unsupported image filter {0} in {1}'.format(f,pdf.fn))
+    if invert:
+        im = Image.eval(im.convert('L'),lambda x: 255-x)
+    return im
+
+_pdfFiles = OrderedDict()
+maxPdfFiles = 4
+
+def getPdfFile(fn):
+    """Return the PdfFile of fn; the most recently used ones are kept open
+    """
+    key = (os.path.abspath(fn),os.path.getmtime(fn))
+    pdf = _pdfFiles.pop(key,None)
+    if pdf is None:
+        pdf = PdfFile(fn)
+        if len(_pdfFiles) >= maxPdfFiles:
+            _pdfFiles.popitem(last=False)
+    _pdfFiles[key] = pdf
+    return pdf
+
+pageNameRe = re.compile(r'^(.*\.pdf)\[(\d+)\]$',re.IGNORECASE)
+
+def isPdf(fn):
+    return os.path.splitext(fn)[1].lower() == '.pdf'
+
+def splitPageName(name):
+    """Return the PDF filename and page number of a page name, or None if
+    name is not a page name
+    """
+    m = pageNameRe.match(name)
+    if m is None:
+        return None
+    return m.group(1),int(m.group(2))
+
+def getPageNames(fn):
+    """Return the page names of the pages of the PDF file fn that have an
+    image
+    """
+    return ['{0}[{1}]'.format(fn,i) for i in getPdfFile(fn).pageImages.keys()]
+
+def getPageFilenameBase(name):
+    """Return a name for output files of the PDF page name (like that of
+    pdfimages)
+    """
+    fn,pageNr = splitPageName(name)
+    return '{0}-page-{1:03d}'.format(os.path.splitext(os.path.basename(fn))[0],pageNr)
+
+def getPageImageData(name):
+    fn,pageNr = splitPageName(name)
+    return getPdfFile(fn).getImageData(pageNr)
+
+def getPagePattern(name,width=None):
+    """Return the image of the PDF page name like getGreyscaleImage does
+    for image files: a (rows, columns) uint8 array, resized to width if
+    width is not None
+    """
+    fn,pageNr = splitPageName(name)
+    return getGreyscaleImage(getPdfFile(fn).getImage(pageNr,width),width)
+
+if __name__ == '__main__':
+    pass
@@ -18,86 +18,404 @@
 #    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
 
 import os, logging
+from collections import deque
+from itertools import islice
 import numpy as nu
-from misc.utilities import cachedProperty, FakePool
-from multiprocessing import Pool
-from scoreImage import ScoreImage
+from misc.utilities import cachedProperty, FakePool, propertyProfile, mergeProfiles, formatProfile
+from multiprocessing import Pool, cpu_count
+from scoreImage import ScoreImage, FailedPageSummary, getFilenameBase
+from agentPainter import AgentPainter
+from pdf import isPdf, getPageNames
 
 # all this KeyboardInterrupt stuff is a workaround of bug
 # http://bugs.python.org/issue8296
 
 class KeyboardInterruptError(Exception): pass
 
-def processPage(imgFile):
+def processPage(args):
+    """
+    Recognize a page, and return its key and PageSummary. If draw is
+    True, the page image is returned in the image attribute of the
+    PageSummary, so that the annotated score can be drawn without loading
+    the page again. If the page cannot be processed (e.g. because the
+    image file is corrupt), the error is logged and a FailedPageSummary
+    is returned, so that the other pages are still processed.
+    """
+    key,imgFile,cache,pageOptions,profile,draw = args
     try:
-        si = ScoreImage(imgFile)
-        si.bars
-        return si
+        if profile:
+            propertyProfile.start()
+        try:
+            si = ScoreImage(imgFile,**pageOptions)
+            if cache is None:
+                summary = si.summary
+            else:
+                summary = cache.getSummary(si)
+            if draw:
+                summary.image = si.img
+        except Exception as e:
+            logging.getLogger(__name__).exception('Failed to process page {0}'.format(imgFile))
+            summary = FailedPageSummary(imgFile,'{0}: {1}'.format(type(e).__name__,e))
+        if profile:
+            summary.profile = propertyProfile.stop()
+        return key,summary
     except KeyboardInterrupt:
         raise KeyboardInterruptError()
 
-pool = Pool()
+_pool = None
+_poolJobs = None
 
-class Piece(object):
-    def __init__(self,imgFiles):
-        self.imgFiles = imgFiles
-    
-    @cachedProperty
-    def imgs(self):
-        log = logging.getLogger(__name__)
-        imgs = []
+def getPool(jobs=None):
+    """Return the worker pool, creating it if necessary. jobs is the
+    number of worker processes (default: the number of CPUs); when jobs
+    is 1, pages are processed in the current process.
+    """
+    global _pool, _poolJobs
+    if _pool is not None and _poolJobs != jobs:
+        closePool()
+    if _pool is None:
+        _pool = FakePool() if jobs == 1 else Pool(jobs)
+        _poolJobs = jobs
+    return _pool
+
+def closePool(terminate=False):
+    global _pool, _poolJobs
+    if _pool is None:
+        return
+    log = logging.getLogger(__name__)
+    if terminate:
+        _pool.terminate()
+        log.info('Pool is terminated')
+    else:
+        _pool.close()
+    log.info('Joining pool processes')
+    _pool.join()
+    log.info('Join complete')
+    _pool = None
+    _poolJobs = None
+
+def getBarCoordinateLines(pageNr,bar_start,page):
+    return [[pageNr,bar_start+i]+list(bb) for i,bb in enumerate(page.barBoundingBoxes)]
+
+def drawAnnotatedScore(page,bar_start,outputDir,image):
+    ap = AgentPainter(image)
+    page.drawAnnotatedScore(ap,bar_start)
+    ap.writeImage(os.path.join(outputDir,page.filenameBase+'.png'),absolute=True)
+
+def renderPage(args):
+    """
+    Draw and write the annotated score of a page. If this fails, the error
+    is logged and returned, so that the other pages are still drawn.
+    """
+    try:
         try:
-            imgs = pool.map(processPage,self.imgFiles)
-        except KeyboardInterrupt:
-            log.info('Got ^C while pool mapping, terminating the pool')
-            pool.terminate()
-            log.info('Pool is terminated')
-            log.info('Joining pool processes')
-            pool.close()
-            pool.join()
-            log.info('Join complete')
-        except Exception, e:
-            log.info('Got exception: %r, terminating the pool' % (e,))
-            pool.terminate()
-            log.info('Pool is terminated')
-            log.info('Joining pool processes')
-            pool.close()
-            pool.join()
-            log.info('Join complete')
-        return imgs
-
-    def drawAnnotatedScores(self,outputDir):
-        bar_i = 1
-        for img in self.imgs:
-            # this draws the annotations on the internally
-            # stored image
-            img.drawAnnotatedScore(bar_i)
-            # this writes the internally stored image to a file
-            img.ap.writeImage(os.path.join(outputDir,img.filenameBase+'.png'),absolute=True)
-            bar_i += len(img.bars)
+            drawAnnotatedScore(*args)
+        except Exception as e:
+            logging.getLogger(__name__).exception('Failed to draw page {0}'.format(args[0].fn))
+            return '{0}: {1}'.format(type(e).__name__,e)
+    except KeyboardInterrupt:
+        raise KeyboardInterruptError()
 
-    @cachedProperty
-    def barCoordinates(self):
-        bar_i = 0
-        bb = []
-        for j,img in enumerate(self.imgs):
-            bb.extend([[j,bar_i+i]+list(bar.boundingBoxes) for i,bar in enumerate(img.bars)])
-            bar_i += len(img.bars)
-        return bb
-
-    def writeBarCoordinates(self,outputDir):
-        cpfx = os.path.commonprefix([x.filenameBase for x in self.imgs])
-        fname = ''.join([cpfx, '-' if len(cpfx) > 0 else '', 'barBoundingBoxes.txt'])
-        fname = os.path.join(outputDir,fname)
+def iterPieces(pieces,jobs=None,cache=None,pageOptions=None,profile=False,draw=False,ahead=2):
+    """
+    Process the pages of all pieces as a single stream of tasks, so that
+    the workers move on to the pages of the next piece while the last
+    pages of a piece are still being processed. Yield (piece, pageNr,
+    PageSummary) triples in page order, as soon as a page and all pages
+    before it are done. At most ahead pages per worker are submitted to
+    the pool before they are yielded, so that tasks that are submitted
+    while the pages are yielded (e.g. drawing the annotated scores, see
+    PieceOutput) run in between, rather than after all pages. If cache
+    is a ResultCache, results are taken from and stored in it.
+    pageOptions are passed as keyword arguments to ScoreImage. If profile
+    is True, the computations of the cachedProperties of each page are
+    recorded in the profile attribute of its PageSummary (see
+    misc.utilities.PropertyProfile). If draw is True, the page image is
+    passed along in the image attribute of each PageSummary (see
+    processPage).
+    """
+    log = logging.getLogger(__name__)
+    pool = getPool(jobs)
+    pageOptions = pageOptions or {}
+    tasks = (((k,i),fn,cache,pageOptions,profile,draw) for k,piece in enumerate(pieces)
+             for i,fn in enumerate(piece.imgFiles))
+    submitted = deque(pool.apply_async(processPage,(task,))
+                      for task in islice(tasks,ahead*(jobs or cpu_count())))
+    try:
+        while len(submitted) > 0:
+            # without a timeout, get cannot be interrupted by ^C
+            (k,i),page = submitted.popleft().get(2**31)
+            yield pieces[k],i,page
+            for task in islice(tasks,1):
+                submitted.append(pool.apply_async(processPage,(task,)))
+    except KeyboardInterrupt:
+        log.info('Got ^C while processing pages, terminating the pool')
+        closePool(terminate=True)
+    except Exception, e:
+        log.error('Got exception: %r, terminating the pool' % (e,))
+        closePool(terminate=True)
+        raise
+
+class PieceOutput(object):
+    """
+    Write the output of a piece page by page: annotated scores if draw is
+    True, bar bounding boxes and a table of the pages (the bar numbers of
+    each page, and whether it was skipped for having no staffs) if
+    barCoordinates is True, and a report of the profiles of the pages and
+    of the piece if profile is True. Pages that failed (see
+    FailedPageSummary), or whose annotated score could not be drawn, are
+    listed in failed (the latter once finish is called). Pages
+    must be passed to writePage in page order, with their page images
+    (see processPage) if draw is True. The annotated scores are drawn by
+    the workers of pool (while they recognize the next pages); finish
+    waits until they are written.
+    """
+    def __init__(self,piece,outputDir,draw=False,barCoordinates=False,pool=None,profile=False):
+        self.piece = piece
+        self.outputDir = outputDir
+        self.profile = profile
+        self.draw = draw
+        self.pool = pool if pool is not None else FakePool()
+        self.rendering = []
+        self.pages = []
+        self.failed = []
+        self.bar_i = 0
+        self.f = None
+        self.pagesFile = None
+        if barCoordinates:
+            log = logging.getLogger(__name__)
+            fname = piece.getBarCoordinatesFilename(outputDir)
+            try:
+                log.info('Writing bar bounding boxes to file {0}'.format(fname))
+                self.f = open(fname,'w')
+                self.f.write('# pageNr barNr (topLeft_v topLeft_h botRight_v botRight_h)+')
+            except IOError:
+                log.error('Cannot write to file {0}'.format(fname))
+            fname = piece.getPagesFilename(outputDir)
+            try:
+                self.pagesFile = open(fname,'w')
+                self.pagesFile.write('# pageNr firstBarNr nBars skipped failed filename\n')
+            except IOError:
+                log.error('Cannot write to file {0}'.format(fname))
+
+    def writePage(self,pageNr,page):
+        if page.error is not None:
+            self.failed.append(page)
+        # the page image is only passed along if the score is drawn
+        image = page.__dict__.pop('image',None)
+        if self.draw and image is not None:
+            self.rendering.append((page,self.pool.apply_async(renderPage,((page,self.bar_i+1,self.outputDir,image),))))
+        if self.f is not None:
+            for line in getBarCoordinateLines(pageNr,self.bar_i,page):
+                self.f.write(' '.join(['{0:d}'.format(x) for x in line])+'\n')
+            self.f.flush()
+        if self.pagesFile is not None:
+            self.pagesFile.write('{0:d} {1:d} {2:d} {3:d} {4:d} {5}\n'.format(
+                    pageNr,self.bar_i,page.getNrOfBars(),page.skipped,page.error is not None,page.fn))
+            self.pagesFile.flush()
+        self.bar_i += page.getNrOfBars()
+        self.pages.append(page)
+
+    def ready(self):
+        """Whether the annotated scores have been written
+        """
+        return all(result.ready() for page,result in self.rendering)
+
+    def finish(self):
+        """Wait until the annotated scores have been written
+        """
+        rendering,self.rendering = self.rendering,[]
+        if self.pool is not _pool and not isinstance(self.pool,FakePool):
+            # the pool has been terminated
+            return
+        for page,result in rendering:
+            # without a timeout, get cannot be interrupted by ^C
+            error = result.get(2**31)
+            if error is not None:
+                self.failed.append(FailedPageSummary(page.fn,error))
+
+    def writeProfile(self):
+        fname = self.piece.getProfileFilename(self.outputDir)
         log = logging.getLogger(__name__)
+        profiles = [getattr(page,'profile',{}) for page in self.pages]
         try:
-            log.info('Writing bar bounding boxes to file {0}'.format(fname))
+            log.info('Writing profile to file {0}'.format(fname))
             with open(fname,'w') as f:
-                f.write('# pageNr barNr (topLeft_v topLeft_h botRight_v botRight_h)+')
-                for line in self.barCoordinates:
-                    f.write(' '.join(['{0:d}'.format(x) for x in line])+'\n')
-        except OSError:
+                title = 'piece' if self.piece.name is None else 'piece {0}'.format(self.piece.name)
+                f.write(formatProfile(mergeProfiles(profiles),title))
+                for page,records in zip(self.pages,profiles):
+                    f.write('\n'+formatProfile(records,'page {0}'.format(page.fn)))
+        except IOError:
             log.error('Cannot write to file {0}'.format(fname))
 
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if self.pagesFile is not None:
+            self.pagesFile.close()
+            self.pagesFile = None
+        if self.profile:
+            self.writeProfile()
+            self.profile = False
+
+def writeBatchOutput(pieces,outputDir,draw=False,barCoordinates=False,jobs=None,cache=None,
+                     pageOptions=None,profile=False):
+    """
+    Process many pieces with a single worker pool, and write the output
+    of each piece to a subdirectory of outputDir named after the piece,
+    page by page as its pages are done. A piece is finished (and its
+    output dropped) as soon as its last page is done and its annotated
+    scores are written. Return the pages that failed.
+    """
+    log = logging.getLogger(__name__)
+    pieces = [piece for piece in pieces if len(piece.imgFiles) > 0]
+    outputs = {}
+    # pieces whose annotated scores are still being drawn, in order
+    drawing = deque()
+    failed = []
+    def finish(piece,output):
+        output.finish()
+        failed.extend(output.failed)
+        log.info('Finished piece {0}'.format(piece.name))
+    try:
+        for piece,j,page in iterPieces(pieces,jobs,cache,pageOptions,profile,draw):
+            if piece not in outputs:
+                pieceDir = os.path.join(outputDir,piece.name)
+                if not os.path.isdir(pieceDir):
+                    os.makedirs(pieceDir)
+                outputs[piece] = PieceOutput(piece,pieceDir,draw,barCoordinates,getPool(jobs),profile)
+            outputs[piece].writePage(j,page)
+            if j == len(piece.imgFiles)-1:
+                outputs[piece].close()
+                drawing.append((piece,outputs.pop(piece)))
+            # the annotated scores are drawn while the next pages are processed
+            while len(drawing) > 0 and drawing[0][1].ready():
+                finish(*drawing.popleft())
+        while len(drawing) > 0:
+            finish(*drawing.popleft())
+    finally:
+        for output in outputs.values():
+            output.close()
+    return failed
+
+imageExtensions = ('.png','.jpg','.jpeg','.tif','.tiff','.pbm','.pgm','.ppm','.gif','.bmp')
+
+def expandPdfs(filenames):
+    """Replace the PDF files in filenames by the names of their pages
+    (see pdf.py)
+    """
+    names = []
+    for fn in filenames:
+        if isPdf(fn):
+            names.extend(getPageNames(fn))
+        else:
+            names.append(fn)
+    return names
+
+def findPieces(directory):
+    """
+    Return a Piece for every directory in the tree below (and including)
+    directory that contains image files; the image files of a directory,
+    sorted by name, are the pages of the piece, and the path of the
+    directory relative to directory is the name of the piece. Every PDF
+    file is a piece as well, named after its path relative to directory
+    (without extension).
+    """
+    pieces = []
+    directory = os.path.normpath(directory)
+    for dirpath,dirnames,filenames in os.walk(directory):
+        dirnames.sort()
+        imgFiles = sorted([os.path.join(dirpath,fn) for fn in filenames
+                           if os.path.splitext(fn)[1].lower() in imageExtensions])
+        if len(imgFiles) > 0:
+            name = os.path.relpath(dirpath,directory)
+            if name == os.curdir:
+                name = os.path.basename(directory)
+            pieces.append(Piece(imgFiles,name=name))
+        for fn in sorted(filenames):
+            if isPdf(fn):
+                path = os.path.join(dirpath,fn)
+                name = os.path.splitext(os.path.relpath(path,directory))[0]
+                pieces.append(Piece([path],name=name))
+    return pieces
+
+def readManifest(fn):
+    """
+    Return the pieces listed in manifest file fn. Each line of the
+    manifest lists one piece, as the name of the piece followed by the
+    filenames of its pages (separated by whitespace). Relative filenames
+    are taken relative to the directory of the manifest. Empty lines and
+    lines starting with '#' are ignored.
+    """
+    pieces = []
+    base = os.path.dirname(fn)
+    with open(fn) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith('#'):
+                continue
+            pieces.append(Piece([os.path.join(base,x) for x in fields[1:]],name=fields[0]))
+    return pieces
+
+class Piece(object):
+    def __init__(self,imgFiles,jobs=None,name=None,cache=None,pageOptions=None,profile=False):
+        # PDF files are replaced by their pages
+        self.imgFiles = expandPdfs(imgFiles)
+        self.jobs = jobs
+        self.name = name
+        self.cache = cache
+        self.pageOptions = pageOptions
+        self.profile = profile
+
+    def iterPages(self,draw=False):
+        """
+        Process the pages, and yield (pageNr, PageSummary) pairs in page
+        order. Pages are processed in parallel, and each page is yielded
+        as soon as it and all pages before it are done. If draw is True,
+        the page images are passed along (see processPage).
+        """
+        for piece,j,page in iterPieces([self],self.jobs,self.cache,self.pageOptions,self.profile,draw):
+            yield j,page
+
+    @cachedProperty
+    def pages(self):
+        return [page for i,page in self.iterPages()]
+
+    def getFilenameBases(self):
+        return [getFilenameBase(fn) for fn in self.imgFiles]
+
+    def getOutputFilename(self,outputDir,name):
+        cpfx = os.path.commonprefix(self.getFilenameBases())
+        fname = ''.join([cpfx, '-' if len(cpfx) > 0 else '', name])
+        return os.path.join(outputDir,fname)
+
+    def getBarCoordinatesFilename(self,outputDir):
+        return self.getOutputFilename(outputDir,'barBoundingBoxes.txt')
+
+    def getPagesFilename(self,outputDir):
+        return self.getOutputFilename(outputDir,'pages.txt')
+
+    def getProfileFilename(self,outputDir):
+        return self.getOutputFilename(outputDir,'profile.txt')
+
+    def writeOutput(self,outputDir,draw=False,barCoordinates=False):
+        """
+        Process the pages and write the requested output for each page as
+        soon as it is available: annotated scores if draw is True, and bar
+        bounding boxes if barCoordinates is True. If the piece is profiled, a
+        report of the profiles is written as well. Return the pages that
+        failed.
+        """
+        output = PieceOutput(self,outputDir,draw,barCoordinates,getPool(self.jobs),self.profile)
+        try:
+            for j,page in self.iterPages(draw):
+                output.writePage(j,page)
+            output.finish()
+        finally:
+            output.close()
+        self.pages = output.pages
+        return output.failed
+
 if __name__ == '__main__':
     pass
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+#    Copyright 2012, Maarten Grachten.
+#
+#    This file is part of CPOMR.
+#
+#    CPOMR is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    CPOMR is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, glob, time, logging, hashlib, tempfile
+import cPickle as pickle
+import numpy as nu
+import scipy
+import PIL
+from PIL import Image
+from pdf import splitPageName, getPageImageData
+
+def log():
+    return logging.getLogger(__name__)
+
+def getCodeVersion():
+    """Return a hash of the source code of the OMR and misc packages, and
+    of the versions of the libraries that the results depend on; cached
+    results computed by other versions of the code are not used
+    """
+    h = hashlib.sha1()
+    srcDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for package in ('OMR','misc'):
+        for fn in sorted(glob.glob(os.path.join(srcDir,package,'*.py'))):
+            with open(fn,'rb') as f:
+                h.update(f.read())
+    h.update(repr([nu.__version__,scipy.__version__,getattr(PIL,'__version__',getattr(Image,'VERSION',None))]))
+    return h.hexdigest()
+
+# the estimated total size of the results in each cache directory, and the
+# number of results stored since the directory was last scanned, in this
+# process (a ResultCache is copied to the worker processes with every page,
+# so the estimate cannot be kept in the ResultCache itself)
+_sizes = {}
+
+class ResultCache(object):
+    """
+    A directory of page recognition results (PageSummary objects),
+    addressed by a hash of the image file contents, the recognition
+    parameters of the ScoreImage, and the version of the code. When the
+    total size of the cached results exceeds maxSize bytes, the least
+    recently used results are removed, down to a fraction evictTo of
+    maxSize. The total size is estimated from the results stored by this
+    process; the directory is only scanned when the estimate exceeds
+    maxSize, and after every scanInterval results (to account for the
+    results of other processes). Temporary files that are older than
+    staleAge seconds (left behind by processes that were killed while
+    storing a result) are removed when the directory is scanned.
+    """
+    suffix = '.pkl'
+    scanInterval = 100
+    evictTo = .9
+    staleAge = 3600
+
+    def __init__(self,directory,maxSize=100*2**20):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.codeVersion = getCodeVersion()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.evict()
+
+    def getKey(self,scoreImage):
+        h = hashlib.sha1(self.codeVersion)
+        h.update(repr(sorted(scoreImage.getParameters().items())))
+        if splitPageName(scoreImage.fn) is not None:
+            h.update(getPageImageData(scoreImage.fn))
+        else:
+            with open(scoreImage.fn,'rb') as f:
+                for block in iter(lambda: f.read(2**20),''):
+                    h.update(block)
+        return h.hexdigest()
+
+    def _path(self,key):
+        return os.path.join(self.directory,key+self.suffix)
+
+    def get(self,key):
+        path = self._path(key)
+        try:
+            with open(path,'rb') as f:
+                result = pickle.load(f)
+        except (IOError,EOFError,pickle.UnpicklingError):
+            return None
+        try:
+            # mark as recently used
+            os.utime(path,None)
+        except OSError:
+            pass
+        return result
+
+    def put(self,key,result):
+        fd,tmp = tempfile.mkstemp(suffix='.tmp',dir=self.directory)
+        try:
+            with os.fdopen(fd,'wb') as f:
+                pickle.dump(result,f,pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            os.rename(tmp,self._path(key))
+        except (IOError,OSError) as e:
+            log().warn('Could not store result in cache: {0}'.format(e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        if self.directory not in _sizes:
+            self.evict()
+            return
+        estimate = _sizes[self.directory]
+        estimate[0] += size
+        estimate[1] += 1
+        if estimate[0] > self.maxSize or estimate[1] >= self.scanInterval:
+            self.evict()
+
+    def evict(self):
+        """If the total size of the results exceeds maxSize, remove the
+        least recently used results until it is at most evictTo*maxSize,
+        and record the total size; also remove stale temporary files
+        """
+        now = time.time()
+        for path in glob.glob(os.path.join(self.directory,'*.tmp')):
+            try:
+                if os.stat(path).st_mtime < now-self.staleAge:
+                    os.remove(path)
+            except OSError:
+                # stored or removed by another process
+                pass
+        entries = []
+        for path in glob.glob(os.path.join(self.directory,'*'+self.suffix)):
+            try:
+                st = os.stat(path)
+            except OSError:
+                # removed by another process
+                continue
+            entries.append((st.st_mtime,st.st_size,path))
+        total = sum(size for mtime,size,path in entries)
+        if total > self.maxSize:
+            entries.sort()
+            for mtime,size,path in entries:
+                if total <= self.evictTo*self.maxSize:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+        _sizes[self.directory] = [total,0]
+
+    def getSummary(self,scoreImage):
+        """Return the PageSummary of scoreImage, from the cache if possible
+        """
+        key = self.getKey(scoreImage)
+        summary = self.get(key)
+        if summary is None:
+            summary = scoreImage.summary
+            self.put(key,summary)
+        else:
+            log().info('Using cached result for image: {0}'.format(scoreImage.fn))
+            # the same image may have been cached under a different name
+            summary.fn = scoreImage.fn
+            summary.filenameBase = scoreImage.filenameBase
+        return summary
+
+if __name__ == '__main__':
+    pass
@@ -18,28 +18,291 @@
 #    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys,os, pickle, logging
+import multiprocessing
 import numpy as nu
 from scipy.stats import distributions
 
-from misc.utilities import cachedProperty
-from imageUtil import writeImageData, getPattern, findValleys, smooth, normalize
+from misc.utilities import cachedProperty, propertyProfile
+from imageUtil import writeImageData, getGreyscaleImage, findValleys, smooth, normalize, ScratchFile, \
+    downsample, refineLinePosition, getStaffCombs
 from agentPainter import AgentPainter
 from verticalSegment import VerticalSegment, identifyNonStaffSegments
 from system import System
 from staff import Staff
-from bar import RightBarLine,LeftBarLine,Bar
+from bar import RightBarLine,LeftBarLine,Bar,getBoundingBoxes
+from pdf import splitPageName, getPagePattern, getPageFilenameBase
 
 def log():
     return logging.getLogger(__name__)
 
+def getFilenameBase(fn):
+    """Return the name of the image file (or PDF page) fn, for naming
+    output files
+    """
+    if splitPageName(fn) is not None:
+        return getPageFilenameBase(fn)
+    return os.path.splitext(os.path.basename(fn))[0]
+
+# the page whose staff segments are processed by the workers of
+# ScoreImage.findStaffLines (the workers inherit it when they are forked)
+_staffPage = None
+
+def getSegmentStaffLines(i):
+    """Return the staff lines of the i-th staff segment of _staffPage, the
+    number of columns visited to find them, and the profile of their
+    computation (if profiling is enabled)
+    """
+    profile = propertyProfile.enabled
+    if profile:
+        propertyProfile.start()
+    vs = _staffPage.getStaffSegments()[i]
+    return vs.staffLines,vs.nColumns,(propertyProfile.records if profile else None)
+
+# the page whose systems are processed by the workers of
+# ScoreImage.findBarLines (the workers inherit it when they are forked)
+_barPage = None
+
+def getSystemBarCandidates(i):
+    """Return the deskewed image of the i-th system of _barPage, its bar
+    candidates (with what they contribute to leftRightMedian), their
+    neighbourhood images, and the profile of their computation (if
+    profiling is enabled)
+    """
+    profile = propertyProfile.enabled
+    if profile:
+        propertyProfile.start()
+    # the scratch file of the page cannot be shared between processes
+    _barPage.scratch = None
+    system = _barPage.systems[i]
+    system.findBarCandidates()
+    return (system.correctedImgSegment,system.barCandidates,
+            [bc.approximateNeighbourhood for bc in system.barCandidates],
+            (propertyProfile.records if profile else None))
+
+def getSystemBarLines(i):
+    """Return the bar candidates of the i-th system of _barPage, the
+    indices of its bar lines among them, the properties of the system
+    that are kept when its images are released (see
+    System.releaseImages), and the profile of their computation (if
+    profiling is enabled)
+    """
+    profile = propertyProfile.enabled
+    if profile:
+        propertyProfile.start()
+    _barPage.scratch = None
+    system = _barPage.systems[i]
+    for bc in system.barLines:
+        bc.barVCoords
+    lines = [system.barCandidates.index(bc) for bc in system.barLines]
+    return (system.barCandidates,lines,system.hSums,system.vSums,system.leftRight,
+            (propertyProfile.records if profile else None))
+
+class PageSummary(object):
+    """
+    The recognition results of a page that are needed for writing output
+    (bar bounding boxes and bar label positions), without the page image
+    and the intermediate results. This is what worker processes pass back
+    to the parent process.
+    """
+    # if not None, the page could not be processed because of this error
+    # (see FailedPageSummary)
+    error = None
+
+    def __init__(self,scoreImage):
+        self.fn = scoreImage.fn
+        self.filenameBase = scoreImage.filenameBase
+        self.pageWidth = scoreImage.pageWidth
+        # True if recognition was skipped because the page has no staffs
+        self.skipped = scoreImage.triage and not scoreImage.hasStaffs
+        self.nSystems = len(scoreImage.systems)
+        # topleft, topright, botleft, botright corners of each system
+        self.systemCorners = [nu.array(system.systemPoints[:4]) for system in scoreImage.systems]
+        # per staff, the (vertical, horizontal) position and angle of each staff line
+        self.staffLines = [nu.array([nu.append(a.getDrawMean(),a.angle) for a in staff.staffLineAgents])
+                           for staff in scoreImage.staffs]
+        self.barBoundingBoxes = [bar.boundingBoxes for bar in scoreImage.bars]
+        self.barTextPositions = [bar.getTextPosition() for bar in scoreImage.bars]
+
+    def getNrOfBars(self):
+        return len(self.barBoundingBoxes)
+
+    def drawAnnotatedScore(self,ap,bar_start=0):
+        if self.nSystems == 0:
+            log().warn('No systems found in image {0}'.format(self.fn))
+            return False
+        color1 = (100,0,100)
+        color2 = (0,200,0)
+        alpha = .2
+        textcolor = (150,0,0)
+        rectangles,colors = [],[]
+        for k,bb in enumerate(self.barBoundingBoxes):
+            color = color1 if (bar_start+k)%2 == 0 else color2
+            for c in bb.reshape((-1,4)):
+                rectangles.append(c)
+                colors.append(color)
+        ap.paintRectangles(rectangles,colors,alpha)
+        positions,sizes = zip(*self.barTextPositions) if self.barTextPositions else ((),())
+        ap.drawTexts(['{0}'.format(bar_start+k) for k in range(len(positions))],
+                     positions,sizes,color=textcolor,alpha=1)
+
+class FailedPageSummary(PageSummary):
+    """
+    The summary of a page that could not be processed because of error (a
+    string describing the exception); it has no systems and no bars, and
+    counts as skipped.
+    """
+    def __init__(self,fn,error):
+        self.fn = fn
+        self.filenameBase = getFilenameBase(fn)
+        self.pageWidth = None
+        self.skipped = True
+        self.error = error
+        self.nSystems = 0
+        self.systemCorners = []
+        self.staffLines = []
+        self.barBoundingBoxes = []
+        self.barTextPositions = []
+
 class ScoreImage(object):
-    def __init__(self,fn):
+    def __init__(self,fn,scratchDir=None,keepSystemImages=True,coarseFactor=1,
+                 systemJobs=1,segmentJobs=1,pageWidth=None,triage=True,staffEngine='agents'):
+        # an image filename, or a page of a PDF file (see pdf.py)
         self.fn = fn
+        # if not None, derived images (deskewed systems, bar neighbourhoods)
+        # are stored in a scratch file in this directory instead of in memory
+        self.scratchDir = scratchDir
+        # if False, the deskewed system images and the bar neighbourhood
+        # images are discarded once the bars have been found (they are
+        # recomputed when needed); this only pays off when the ScoreImage
+        # is kept after the bars are known (see benchmarks/pageMemory.py)
+        self.keepSystemImages = keepSystemImages
+        # if larger than 1, the page is recognized on the image downsampled
+        # by this factor, and the results are refined at full resolution
+        self.coarseFactor = coarseFactor
+        # the number of systems whose bar lines are searched in parallel
+        # (in processes)
+        self.systemJobs = systemJobs
+        # the number of staff segments whose staff lines are tracked in
+        # parallel (in processes)
+        self.segmentJobs = segmentJobs
+        # if not None, the page image is resized to this width while decoding
+        self.pageWidth = pageWidth
+        # if True, pages that show no sign of staffs (see hasStaffs) are
+        # not recognized any further
+        self.triage = triage
+        # how the staff lines of the staff segments are found (see
+        # VerticalSegment.staffLines): 'agents' or 'comb'
+        self.staffEngine = staffEngine
         self.typicalNrOfSystemPerPage = 6
         self.maxAngle = 1.5/180.
         self.nAnglebins = 600
         self.colGroups = 11
         self.bgThreshold = 20
+        self.combStrips = 16
+        self.minCombProminence = .6
+        self.minCombStrips = 3
+
+    def getParameters(self):
+        """Return the parameters that affect the recognition results
+        """
+        return dict(typicalNrOfSystemPerPage=self.typicalNrOfSystemPerPage,
+                    maxAngle=self.maxAngle,
+                    nAnglebins=self.nAnglebins,
+                    colGroups=self.colGroups,
+                    bgThreshold=self.bgThreshold,
+                    coarseFactor=self.coarseFactor,
+                    pageWidth=self.pageWidth,
+                    triage=self.triage,
+                    staffEngine=self.staffEngine)
+
+    @cachedProperty
+    def coarse(self):
+        """The page downsampled by coarseFactor, as a ScoreImage
+        """
+        coarse = ScoreImage(self.fn,scratchDir=self.scratchDir,keepSystemImages=self.keepSystemImages,
+                            systemJobs=self.systemJobs,segmentJobs=self.segmentJobs)
+        for k,v in self.getParameters().items():
+            setattr(coarse,k,v)
+        coarse.coarseFactor = 1
+        log().info('Downsampling image by a factor {0}'.format(self.coarseFactor))
+        img = downsample(self.img,self.coarseFactor)
+        img[img < self.bgThreshold] = 0
+        coarse.img = img
+        return coarse
+
+    def toFine(self,coords):
+        """Map coordinates in self.coarse to coordinates in the image
+        """
+        return nu.asarray(coords,nu.float)*self.coarseFactor+(self.coarseFactor-1)/2.
+
+    def refineBarLine(self,corners,angle,staffLineDistance):
+        """Refine the top and bottom points (rows of corners) of a bar line
+        found in self.coarse: shift the bar line horizontally onto the ink
+        of the bar line, and the points vertically onto the ink of the top
+        and bottom staff lines
+        """
+        maxShift = 2*self.coarseFactor
+        top,bot = self.toFine(corners)
+        mid = refineLinePosition(self.img,(top+bot)/2.,bot-top,
+                                 nu.sum((bot-top)**2)**.5/2.,maxShift)
+        top,bot = top+mid-(top+bot)/2.,bot+mid-(top+bot)/2.
+        staffDir = (nu.sin(nu.pi*angle),nu.cos(nu.pi*angle))
+        return nu.array((refineLinePosition(self.img,top,staffDir,staffLineDistance,maxShift),
+                         refineLinePosition(self.img,bot,staffDir,staffLineDistance,maxShift)))
+
+    def getCoarseToFineSummary(self):
+        """Return the PageSummary of self.coarse, mapped to the full
+        resolution image, with the positions of the staff lines and bar
+        lines refined in narrow bands of the full resolution image
+        """
+        coarse = self.coarse
+        summary = PageSummary(coarse)
+        f = self.coarseFactor
+        summary.systemCorners = [self.toFine(c) for c in summary.systemCorners]
+        staffLines = []
+        for lines in summary.staffLines:
+            lines = lines.copy()
+            for line in lines:
+                staffDir = (nu.sin(nu.pi*line[2]),nu.cos(nu.pi*line[2]))
+                line[:2] = refineLinePosition(self.img,self.toFine(line[:2]),staffDir,
+                                              self.getWidth()/4.,2*f)
+            staffLines.append(lines)
+        summary.staffLines = staffLines
+        if len(coarse.systems) > 0:
+            angle = nu.mean([system.getStaffAngle() for system in coarse.systems])
+            sld = f*nu.mean([system.staffLineDistance for system in coarse.systems])
+        refined = {}
+        barBoundingBoxes = []
+        for bar in coarse.bars:
+            cc = []
+            for corners in bar.cornerCoordinates:
+                # consecutive bars share bar lines
+                key = tuple(corners.ravel())
+                if key not in refined:
+                    refined[key] = self.refineBarLine(corners,angle,sld)
+                cc.append(refined[key])
+            barBoundingBoxes.append(getBoundingBoxes(cc))
+        summary.barBoundingBoxes = barBoundingBoxes
+        summary.barTextPositions = [(self.toFine(pos).astype(nu.int),f*textSize)
+                                    for pos,textSize in summary.barTextPositions]
+        return summary
+
+    @cachedProperty
+    def scratch(self):
+        if self.scratchDir is None:
+            return None
+        return ScratchFile(self.scratchDir)
+
+    def storeImage(self,img):
+        """Return img, or a copy of it backed by the scratch file if there is one
+        """
+        if self.scratch is None:
+            return img
+        return self.scratch.store(img)
+
+    def releaseSystemImages(self):
+        for system in self.systems:
+            system.releaseImages()
 
     @cachedProperty
     def ap(self):
@@ -49,7 +312,10 @@ class ScoreImage(object):
     def img(self):
         log().info('Loading image: {0}'.format(self.fn))
         try:
-            img = 255-getPattern(self.fn,False,False)
+            if splitPageName(self.fn) is None:
+                img = 255-getGreyscaleImage(self.fn,self.pageWidth)
+            else:
+                img = 255-getPagePattern(self.fn,self.pageWidth)
         except IOError as e: 
             log().error('Problem loading image...')
             raise e
@@ -98,10 +364,55 @@ class ScoreImage(object):
                                                                                          origNrStaffs-len(staffs)))
         return staffs
 
+    def findStaffLines(self):
+        """
+        Track the staff lines of the staff segments with segmentJobs
+        processes. The processes are forked once the page image and the
+        angle weights are known, so they share them with this process. The
+        staff lines are stored in the segments in this process, in page
+        order.
+        """
+        global _staffPage
+        if multiprocessing.current_process().daemon:
+            log().info('Pages are processed in worker processes, tracking staff lines serially')
+            return
+        segments = self.getStaffSegments()
+        self.weights
+        _staffPage = self
+        pool = multiprocessing.Pool(min(self.segmentJobs,len(segments)))
+        try:
+            results = pool.map(getSegmentStaffLines,range(len(segments)))
+        finally:
+            pool.close()
+            pool.join()
+            _staffPage = None
+        for vs,(staffLines,nColumns,records) in zip(segments,results):
+            vs.staffLines = staffLines
+            vs.nColumns = nColumns
+            if records is not None:
+                propertyProfile.add(records)
+
+    @cachedProperty
+    def hasStaffs(self):
+        """Whether the page appears to contain staffs: whether the rows of
+        at least minCombStrips strips of the page show the comb of staff
+        lines (see getStaffCombs). This is a quick test to skip blank
+        pages, title pages and text pages.
+        """
+        prominence,lags = getStaffCombs(self.img,self.combStrips)
+        nStrips = nu.sum(prominence > self.minCombProminence)
+        log().info('Staff line comb found in {0} of {1} strips'.format(nStrips,self.combStrips))
+        return nStrips >= self.minCombStrips
+
     @cachedProperty
     def staffs(self):
         draw = False
         staffs = []
+        if self.triage and not self.hasStaffs:
+            log().warn('No staffs found in image {0}, skipping recognition'.format(self.fn))
+            return staffs
+        if self.segmentJobs > 1 and len(self.getStaffSegments()) > 1:
+            self.findStaffLines()
 
         for i,vs in enumerate(self.getStaffSegments()):
             #self.ap.paintHLine(vs.bottom)
@@ -193,11 +504,75 @@ class ScoreImage(object):
         amax = angles[nu.argmax(globalAngleHist)]
         return distributions.norm(amax,.5/180.0).pdf(angles)
 
+    @cachedProperty
+    def leftRightMedian(self):
+        """The median of the leftRightAbsDiffSums of the bar candidates of
+        all systems (that have a neighbourhood)
+        """
+        return nu.median(nu.array([bc.leftRightAbsDiffSums for system in self.systems
+                                   for bc in system.barCandidates
+                                   if bc.approximateNeighbourhood != None]),0)
+
+    def findBarLines(self):
+        """
+        Find the bar lines of the systems with systemJobs processes. This
+        happens in two rounds: first the bar candidates of each system are
+        found, up to the statistics that are needed for leftRightMedian,
+        then the bar lines are selected from the candidates of each system.
+        The processes of each round are forked from this process, so they
+        share the page (and the results of the first round) with it. The
+        bar candidates are sent back without their images (see
+        BarCandidate.__getstate__), and stored in the systems in this
+        process.
+        """
+        if multiprocessing.current_process().daemon:
+            log().info('Pages are processed in worker processes, searching bar lines serially')
+            return
+        systems = self.systems
+        self.scratch
+        for system,(img,barCandidates,neighbourhoods,records) in \
+                zip(systems,self._mapSystems(getSystemBarCandidates)):
+            system.correctedImgSegment = self.storeImage(img)
+            for bc,neighbourhood in zip(barCandidates,neighbourhoods):
+                bc.system = system
+                bc.approximateNeighbourhood = self.storeImage(neighbourhood)
+            system.barLineAgents = [bc.agent for bc in barCandidates]
+            system.barCandidates = barCandidates
+            if records is not None:
+                propertyProfile.add(records)
+        self.leftRightMedian
+        for system,(barCandidates,lines,hSums,vSums,leftRight,records) in \
+                zip(systems,self._mapSystems(getSystemBarLines)):
+            # the candidates of this process keep their images
+            for bc,result in zip(system.barCandidates,barCandidates):
+                bc.__dict__.update(result.__dict__)
+            system.barLineAgents = [bc.agent for bc in system.barCandidates]
+            system.barLines = [system.barCandidates[k] for k in lines]
+            system.hSums,system.vSums,system.leftRight = hSums,vSums,leftRight
+            if records is not None:
+                propertyProfile.add(records)
+
+    def _mapSystems(self,func):
+        """Return func(i) for the index i of each system, computed by
+        systemJobs processes that are forked from this process
+        """
+        global _barPage
+        _barPage = self
+        pool = multiprocessing.Pool(min(self.systemJobs,len(self.systems)))
+        try:
+            return pool.map(func,range(len(self.systems)))
+        finally:
+            pool.close()
+            pool.join()
+            _barPage = None
+
     @cachedProperty
     def bars(self):
         """
         Return bars
         """
+        if self.systemJobs > 1 and len(self.systems) > 1:
+            self.findBarLines()
         bars = []
         bl = [(i,j) for i in range(len(self.systems)) for j in range(len(self.systems[i].barLines))]
         i1,i2 = 0,1
@@ -214,21 +589,21 @@ class ScoreImage(object):
                 if bl1.estimatedType == RightBarLine:
                     i1 += 1
             i2 += 1
+        if not self.keepSystemImages:
+            # the bounding boxes are what the bars need of the images
+            for bar in bars:
+                bar.boundingBoxes
+            self.releaseSystemImages()
         return bars
 
+    @cachedProperty
+    def summary(self):
+        if self.coarseFactor > 1:
+            return self.getCoarseToFineSummary()
+        return PageSummary(self)
+
     def drawAnnotatedScore(self,bar_start=0):
-        if len(self.systems) == 0:
-            log().warn('No systems found in image {0}'.format(self.fn))
-            return False
-        color1 = (100,0,100)
-        color2 = (0,200,0)
-        alpha = .2
-        textcolor = (150,0,0)
-        for k,bar in enumerate(self.bars):
-            color = color1 if (bar_start+k)%2 == 0 else color2
-            #bar.draw(bar_start+k,ptoggle)
-            bar.drawAsRect(bar_start+k,color,alpha)
-            bar.drawText('{0}'.format(bar_start+k),color=textcolor,alpha=1)
+        return self.summary.drawAnnotatedScore(self.ap,bar_start)
 
 
     def drawAnnotatedScore2(self,bar_start=0):
@@ -252,7 +627,7 @@ class ScoreImage(object):
             
     @cachedProperty
     def filenameBase(self):
-        return os.path.splitext(os.path.basename(self.fn))[0]
+        return getFilenameBase(self.fn)
 
     #     for system in self.systems:
     #         #ap = AgentPainter(system.correctedImgSegment)
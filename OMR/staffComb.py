@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+#    Copyright 2012, Maarten Grachten.
+#
+#    This file is part of CPOMR.
+#
+#    CPOMR is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    CPOMR is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Finding the staffs of an image segment from its row projection, as an
+alternative to tracking the staff lines with agents: the rows are summed
+along the angle of the page, and a comb of five equally spaced lines is
+matched to the resulting profile over a range of line distances. The
+staff lines are then fitted to the runs of ink that they cross in a
+number of columns.
+"""
+
+import logging
+import numpy as nu
+from agent import makeAgent
+
+def log():
+    return logging.getLogger(__name__)
+
+def getShearedRowSums(img,slope):
+    """Return the sums of img along lines of slope (rows per column),
+    indexed by the row at which the lines cross the middle column; lines
+    are followed to the nearest pixel
+    """
+    H,W = img.shape
+    shifts = nu.round((nu.arange(W)-W/2.)*slope).astype(nu.int)
+    sums = nu.zeros(H,nu.int)
+    # the shift is constant over runs of columns
+    bounds = nu.append(nu.append(0,nu.nonzero(nu.diff(shifts))[0]+1),W)
+    for a,b in zip(bounds[:-1],bounds[1:]):
+        s = shifts[a]
+        if abs(s) >= H:
+            continue
+        colSums = nu.sum(img[:,a:b],1,dtype=nu.int)
+        if s >= 0:
+            sums[:H-s] += colSums[s:]
+        else:
+            sums[-s:] += colSums[:H+s]
+    return sums
+
+def findStaffCombs(fill,minDistance,maxDistance,minResponse,step=.5):
+    """
+    Match a comb of five staff lines to fill (the proportion of ink per
+    row), for staff line distances from minDistance to maxDistance. The
+    response of the comb at row r and distance d is the smallest fill of
+    its five lines (at r, r+d, ..., r+4d), minus the largest fill halfway
+    between them, where the fill at each row is taken as the largest fill
+    within one row. Combs with half or double the distance of a staff
+    thus respond weakly (also when the lines of the comb fall on the edges
+    of thick staff lines).
+
+    Return the (first row, distance) of the best combs that do not
+    overlap, as long as their response is at least minResponse.
+    """
+    H = len(fill)
+    distances = nu.arange(minDistance,maxDistance+step,step)
+    if len(distances) == 0 or H < 4*minDistance:
+        return []
+    pad = int(nu.ceil(5*distances[-1]))+2
+    f = nu.append(fill,nu.zeros(pad))
+    # tolerate rounding of the line positions
+    fmax = nu.maximum(f,nu.maximum(nu.append(0,f[:-1]),nu.append(f[1:],0)))
+    rows = nu.arange(H)[nu.newaxis,:]
+    def tap(k):
+        # tap(k)[i,r] is fmax at row r+k*distances[i]
+        return fmax[rows+nu.round(k*distances[:,nu.newaxis]).astype(nu.int)]
+    response = reduce(nu.minimum,[tap(k) for k in range(5)])-\
+        reduce(nu.maximum,[tap(k+.5) for k in range(4)])
+    combs = []
+    while True:
+        i,r = nu.unravel_index(nu.argmax(response),response.shape)
+        if response[i,r] < minResponse:
+            break
+        d = distances[i]
+        combs.append((r,d))
+        # staffs do not overlap
+        response[:,max(0,int(r-5*d)):int(r+5*d)+1] = -nu.inf
+    return sorted(combs)
+
+def getLineRuns(runIndex,cols,predicted,tolerance,maxWidth):
+    """
+    Return the runs of ink that lines cross in columns cols (with runs
+    runIndex), where predicted holds the rows of the lines in the columns
+    (an array of shape (lines, columns)). A line crosses a run if the run
+    is at most maxWidth long and reaches the predicted row within
+    tolerance (maxWidth and tolerance may vary per line, as arrays of
+    shape (lines, 1)).
+
+    For each line, return the first and last points of the runs it
+    crosses, as (row, column) arrays xy0 and xy1.
+    """
+    N = len(runIndex)
+    runs = runIndex.runs
+    if len(runs) == 0:
+        return [(nu.zeros((0,2)),nu.zeros((0,2)))]*predicted.shape[0]
+    # the rows of column j are offset by j*stride, so that the runs of all
+    # columns can be searched at once
+    stride = int(max(nu.max(runs),nu.max(nu.abs(predicted)))+nu.max(tolerance))+2
+    colOf = nu.repeat(nu.arange(N),nu.diff(runIndex.offsets))
+    idx = nu.searchsorted(colOf*stride+runs[:,1],
+                          nu.arange(N)[nu.newaxis,:]*stride+predicted-tolerance)
+    idx = nu.minimum(idx,len(runs)-1)
+    found = ((colOf[idx] == nu.arange(N)[nu.newaxis,:]) &
+             (runs[idx,0] <= predicted+tolerance) &
+             (runs[idx,1] >= predicted-tolerance) &
+             (runs[idx,1]-runs[idx,0]+1 <= maxWidth))
+    cols = nu.asarray(cols,nu.float)
+    result = []
+    for line in range(predicted.shape[0]):
+        j = nu.nonzero(found[line])[0]
+        r = runs[idx[line,j]]
+        result.append((nu.column_stack((r[:,0],cols[j])),nu.column_stack((r[:,1],cols[j]))))
+    return result
+
+def getCombStaffLines(img,cols,runIndex,angle,agentConfig,M,minResponse=.3,
+                      minDistance=4,maxDistance=None,minCoverage=.5,maxDistanceDev=.1):
+    """
+    Find the staffs of img (a segment of the page, with ink nonzero) with
+    a comb (see findStaffCombs) on the row sums along angle (in units of
+    pi), and fit agents to the runs of ink of the staff lines in columns
+    cols (with runs runIndex). M is the width of the page.
+
+    Return the staff lines as lists of five agents per staff (like
+    VerticalSegment.staffLines), or None if the fit is poor: if no staffs
+    are found, if a staff line crosses runs of ink in less than
+    minCoverage of the columns, if its agent is not acceptable (see
+    Agent.died), or if the staff line distances of a staff vary by more
+    than maxDistanceDev of their mean.
+    """
+    H,W = img.shape
+    if maxDistance is None:
+        maxDistance = min(H/5.,W/40.)
+    slope = nu.tan(angle*nu.pi)
+    fill = getShearedRowSums(img,slope)/(255.*W)
+    combs = findStaffCombs(fill,minDistance,maxDistance,minResponse)
+    if len(combs) == 0:
+        log().info('No staff comb found')
+        return None
+    firstRows = nu.array([r+d*nu.arange(5) for r,d in combs]).ravel()
+    distance = nu.array([d for r,d in combs]).repeat(5)
+    predicted = firstRows[:,nu.newaxis]+(nu.asarray(cols)[nu.newaxis,:]-W/2.)*slope
+    lineRuns = getLineRuns(runIndex,cols,predicted,distance[:,nu.newaxis]/3.,
+                           nu.maximum(3,distance[:,nu.newaxis]/2.))
+    agents = []
+    for xy0,xy1 in lineRuns:
+        if len(xy0) < max(2,minCoverage*len(cols)):
+            log().info('Staff line found in {0} of {1} columns'.format(len(xy0),len(cols)))
+            return None
+        agent = makeAgent(agentConfig,xy0,xy1)
+        if agent.died():
+            log().info('Poor staff line fit: {0}'.format(agent))
+            return None
+        agents.append(agent)
+    staffLines = [agents[k:k+5] for k in range(0,len(agents),5)]
+    for staff in staffLines:
+        dists = nu.diff([a.getMiddle(M) for a in staff])
+        if nu.std(dists) > maxDistanceDev*nu.mean(dists):
+            log().info('Irregular staff line distances: {0}'.format(dists))
+            return None
+    return staffLines
+
+if __name__ == '__main__':
+    pass
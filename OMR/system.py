@@ -22,7 +22,7 @@ import numpy as nu
 from misc.utilities import cachedProperty
 from agent import AgentConfig, assignToAgents, mergeAgents
 from agentPainter import AgentPainter
-from imageUtil import getAntiAliasedImg, smooth, Rotator, selectColumns
+from imageUtil import getDerotatedImg, smooth, Rotator, selectColumns, RunIndex
 from bar import BarCandidate
 
 def log():
@@ -190,16 +190,18 @@ class System(object):
         hsums = nu.sum(img,1)[int(systemTopL):int(systemBotL)]
         rows = selectColumns(hsums,vbins)[0]+int(systemTopL) # sounds funny, change name of function       
 
-        ap = AgentPainter(self.correctedImgSegment)
-        ap.paintVLine(yoffset,step=4,color=(50,150,50))
-        ap.paintVLine(rightBorder,step=4,color=(50,150,50))
         draw = False
+        if draw:
+            ap = AgentPainter(self.correctedImgSegment)
+            ap.paintVLine(yoffset,step=4,color=(50,150,50))
+            ap.paintVLine(rightBorder,step=4,color=(50,150,50))
         K = int(.1*len(rows))
+        runIndex = RunIndex(img[rows[:K],:])
         for i,r in enumerate(rows[:K]):
             died = []
-            agentsnew,d = assignToAgents(img[r,:],agents,BarAgentConfig,
+            agentsnew,d = assignToAgents(None,agents,BarAgentConfig,
                                          self.correctedImgSegment.shape[1],
-                                         vert=r,fixAgents=False)
+                                         vert=r,fixAgents=False,runs=runIndex[i])
             died.extend(d)
 
             if len(agents) > 2:
@@ -254,6 +256,14 @@ class System(object):
         bars = [BarCandidate(self,x) for x in self.barLineAgents]
         return bars
 
+    def findBarCandidates(self):
+        """Compute the bar candidates, and what they contribute to the
+        page-wide statistics of ScoreImage.leftRightMedian
+        """
+        for bc in self.barCandidates:
+            if bc.approximateNeighbourhood != None:
+                bc.leftRightAbsDiffSums
+
     def getSystemWidth(self):
         # this gets cut off from the width, to fit in the page rotated
         cutOff = nu.abs(self.getSystemHeight()*nu.tan(nu.pi*self.getStaffAngle()))
@@ -271,10 +281,23 @@ class System(object):
     @cachedProperty
     def correctedImgSegment(self):
         halfSystemWidth = int((self.getSystemWidth()-1)/2)
-        xx,yy = nu.mgrid[0:self.getSystemHeight(),-halfSystemWidth:halfSystemWidth]
-        yy += self.getLowerMidLocal()[1]
-        xxr,yyr = self.rotator.derotate(xx,yy)
-        return getAntiAliasedImg(self.scrImage.img,xxr,yyr)
+        rows = nu.arange(0,self.getSystemHeight())
+        cols = nu.arange(-halfSystemWidth,halfSystemWidth)+self.getLowerMidLocal()[1]
+        return self.scrImage.storeImage(getDerotatedImg(self.scrImage.img,self.rotator,rows,cols))
+
+    def releaseImages(self):
+        """Discard the deskewed system image and the neighbourhood images of
+        the bar candidates (they are recomputed when needed), keeping what is
+        derived from them for the bar lines
+        """
+        self.hSums
+        self.vSums
+        self.leftRight
+        for bc in self.barLines:
+            bc.barVCoords
+        for bc in self.barCandidates:
+            bc.releaseImages()
+        del self.correctedImgSegment
 
 if __name__ == '__main__':
     pass
@@ -22,8 +22,9 @@ import logging
 import numpy as nu
 from misc.utilities import cachedProperty
 from agent import assignToAgents, mergeAgents, AgentConfig
-from imageUtil import normalize, selectColumns
+from imageUtil import selectColumns, RunIndex
 from staff import assessStaffLineAgents
+from staffComb import getCombStaffLines
 
 def identifyNonStaffSegments(vertSegments,N,M):
     """Identify vertical segments that are unlikely to contain staffs
@@ -43,20 +44,47 @@ def identifyNonStaffSegments(vertSegments,N,M):
     log.info('Of {0} segments, items {1} were identified as non-staff'.format(len(vertSegments),nonStaff))
     return nonStaff
 
-def getOffset(v1,v2,dx,maxAngle):
-    #kmax = min(70,int(1.5*nu.ceil(dx*nu.tan(maxAngle*nu.pi))))
-    kmax = 50
-    N = len(v1)
-    dotproducts = []
-    rng = []
-    for i in range(-kmax,kmax+1):
-        b = min(max(0,i),N)
-        e = max(0,min(N,N-i))
-        if e > 0:
-            dotproducts.append(nu.dot(v1[:e],v2[b:]))
-            rng.append(i)
-    ndp = normalize(nu.array(dotproducts))
-    return ndp, -rng[nu.argmax(ndp)]
+def getOffsets(v1,v2,kmax=50):
+    """Estimate the vertical offset between corresponding columns of v1
+    and v2 (arrays of shape (rows, pairs)), by cross-correlating each pair
+    of columns over the shifts [-kmax,kmax]. All pairs are correlated at
+    once, through FFTs along the columns.
+
+    Return the offsets (one per pair), and a boolean array that is False
+    for pairs whose correlation does not vary with the shift (e.g. empty
+    columns), and for which the offset is meaningless.
+    """
+    N,P = v1.shape
+    kmax = min(kmax,N-1)
+    # zero-pad to avoid circular wrap-around of shifts within [-kmax,kmax]
+    L = 2**int(nu.ceil(nu.log2(N+kmax)))
+    f1 = nu.fft.rfft(v1.astype(nu.float),L,axis=0)
+    f2 = nu.fft.rfft(v2.astype(nu.float),L,axis=0)
+    # cc[k,p] = sum_t v1[t,p]*v2[t+k,p]
+    cc = nu.fft.irfft(nu.conj(f1)*f2,L,axis=0)
+    rng = nu.arange(-kmax,kmax+1)
+    dotproducts = nu.round(cc[rng%L,:])
+    valid = nu.max(dotproducts,0) > nu.min(dotproducts,0)
+    return -rng[nu.argmax(dotproducts,0)], valid
+
+def getAgentEnds(agents,M):
+    """Return the vertical positions of the lines of agents at the left
+    and right border of a page of width M, as a dictionary with agents as
+    keys
+    """
+    ends = {}
+    for a in agents:
+        t = nu.tan(a.angle*nu.pi)
+        ends[a] = nu.array((a.mean[0]-a.mean[1]*t,a.mean[0]+(M-a.mean[1])*t))
+    return ends
+
+def getAgentChange(ends0,ends1):
+    """Return the largest shift of the ends (see getAgentEnds) of the
+    agents between ends0 and ends1, or None if the agents differ
+    """
+    if ends0 is None or set(ends0) != set(ends1) or len(ends1) == 0:
+        return None
+    return max(nu.max(nu.abs(ends1[a]-ends0[a])) for a in ends1)
 
 class VerticalSegment(object):
     def __init__(self,scoreImage,top,bottom,colGroups=11,
@@ -70,6 +98,11 @@ class VerticalSegment(object):
         self.nPerStaff = 5
         self.containsStaff = True
         self.draw = False
+        # the number of columns visited by staffLines
+        self.nColumns = None
+        # the number of columns per group of columns to which the comb
+        # staff lines are fitted
+        self.nCombColumns = 8
 
     def getVHSums(self):
         vsum = len(nu.nonzero(self.vSums)[0])
@@ -82,41 +115,107 @@ class VerticalSegment(object):
     def hasStaff(self):
         return self.containsStaff
         
+    def getStaffAgentConfig(self):
+        return AgentConfig(targetAngle=self.angle,
+                           maxAngleDev=2/180.,
+                           minScore=-2,
+                           maxError=self.scrImage.getWidth()/2000.,
+                           offset=self.top)
+
+    def getRunIndex(self,cols):
+        """Return the runs of ink of the segment in columns cols, as a RunIndex
+        """
+        return RunIndex(self.getImgSegment()[:,cols].T)
+
     @cachedProperty
     def staffLines(self):
+        """The staff lines of the segment, as lists of nPerStaff agents
+        (one list per staff, from top to bottom). They are found by the
+        staff engine of the page: 'agents' tracks the staff lines column
+        by column (see trackStaffLines), 'comb' finds them in the row
+        projection of the segment (see combStaffLines), falling back to
+        tracking when the comb does not fit well.
+        """
+        log = logging.getLogger(__name__)
+        log.info('Default angle for this staff: {0:.5f} rad/PI'.format(self.angle))
+        if self.scrImage.staffEngine == 'comb':
+            staffLines = self.combStaffLines()
+            if staffLines is not None:
+                return staffLines
+            log.info('Poor staff comb fit, tracking staff lines instead')
+        return self.trackStaffLines()
+
+    def combStaffLines(self):
+        """Return the staff lines found by getCombStaffLines, fitted to the
+        runs of ink in nCombColumns columns of the segment per group of
+        columns, or None if the comb does not fit well
+        """
+        cols = selectColumns(self.vSums,self.colGroups)[0][:self.nCombColumns*self.colGroups]
+        staffLines = getCombStaffLines(self.getImgSegment(),cols,self.getRunIndex(cols),
+                                       self.angle,self.getStaffAgentConfig(),self.scrImage.getWidth())
+        if staffLines is not None:
+            self.nColumns = len(cols)
+            logging.getLogger(__name__).info('Fitted {0} staffs to the runs in {1} columns'
+                                             .format(len(staffLines),len(cols)))
+        return staffLines
+
+    def trackStaffLines(self):
         agents = []
-        defAngle = self.angle
         cols = selectColumns(self.vSums,self.colGroups)[0]
-        staffAgentConfig = AgentConfig(targetAngle=defAngle,
-                                       maxAngleDev=2/180.,
-                                       minScore=-2,
-                                       maxError=self.scrImage.getWidth()/2000.,
-                                       offset=self.top)
+        staffAgentConfig = self.getStaffAgentConfig()
         f0 = os.path.splitext(self.scrImage.fn)[0]
         log = logging.getLogger(__name__)
-        log.info('Default angle for this staff: {0:.5f} rad/PI'.format(defAngle))
-        stop = False
         finalStage = False
-        nFinalRuns = 20
+        M = self.scrImage.getWidth()
+        # The staff lines are stable when the ends of the selected agents
+        # have shifted less than tolerance pixels per column, for window
+        # consecutive columns (in which every group of columns is visited).
+        # The agents are accepted as staff lines once they are stable (but
+        # not before minColumns), or once they are assessed to be staff
+        # lines after maxSearchColumns; the accepted staff lines are then
+        # tracked until they are stable (for minFinalRuns to maxFinalRuns
+        # columns)
+        tolerance = M/20000.
+        window = self.colGroups
+        minColumns = 2*self.colGroups
+        maxSearchColumns = 50
+        minFinalRuns,maxFinalRuns = 5,60
+        nColumns = 0
+        nFinalRuns = 0
+        nStable = 0
+        ends = None
         draw = self.draw
+        # the tracking usually stops long before all columns are visited,
+        # so the runs are extracted for a block of columns at a time
+        blockSize = 64
         for i,c in enumerate(cols):
-            if nFinalRuns == 0:
+            if finalStage and (nFinalRuns >= maxFinalRuns or
+                               (nFinalRuns >= minFinalRuns and nStable >= window)):
                 break
-            agentsnew,died = assignToAgents(self.getImgSegment()[:,c],agents,staffAgentConfig,
-                                            self.scrImage.getWidth(),horz=c,fixAgents=finalStage)
+            if i % blockSize == 0:
+                runIndex = self.getRunIndex(cols[i:i+blockSize])
+            agentsnew,died = assignToAgents(None,agents,staffAgentConfig,
+                                            self.scrImage.getWidth(),horz=c,fixAgents=finalStage,
+                                            runs=runIndex[i % blockSize])
             if len(agentsnew) > 3:
                 agentsnew,d = mergeAgents(agentsnew)
             agents = agentsnew
             agents.sort(key=lambda x: -x.score)
+            nColumns += 1
 
-            if len(agents) > 4 and i > 50 and not finalStage:
-                finalStage,selection = assessStaffLineAgents(agents,self.scrImage.getWidth(),
-                                                             self.nPerStaff)
-                if finalStage:
-                    agents = selection
-            
+            isStaff,selection = finalStage,[]
             if finalStage:
-                nFinalRuns -= 1
+                selection = agents
+                nFinalRuns += 1
+            elif len(agents) > 4 and i >= minColumns:
+                isStaff,selection = assessStaffLineAgents(agents,M,self.nPerStaff)
+            newEnds = getAgentEnds(selection,M)
+            change = getAgentChange(ends,newEnds)
+            nStable = nStable+1 if change is not None and change < tolerance else 0
+            ends = newEnds
+            if not finalStage and isStaff and (i > maxSearchColumns or nStable >= window):
+                finalStage = True
+                agents = selection
 
             if draw:
                 self.scrImage.ap.reset()
@@ -126,6 +225,8 @@ class VerticalSegment(object):
                         self.scrImage.ap.register(a)
                     self.scrImage.ap.drawAgentGood(a,-3000,3000)
                 self.scrImage.ap.writeImage(f0+'-{0:04d}-c{1}'.format(i,c)+'.png')
+        self.nColumns = nColumns
+        log.info('Tracked staff lines in {0} columns ({1} after accepting them)'.format(nColumns,nFinalRuns))
         agents.sort(key=lambda x: x.getMiddle(self.scrImage.getWidth()))
         return [agents[k*self.nPerStaff:(k+1)*self.nPerStaff] 
                 for k in range(len(agents)/self.nPerStaff)]
@@ -146,15 +247,15 @@ class VerticalSegment(object):
         #self.vSums = nu.sum(self.scrImage.img[self.top:self.bottom,:],0)
         hparts = 3
         cols = selectColumns(self.vSums,hparts)[0]
-        angles = []
         nColsToProcess = int(2*len(cols)/10)
-        for j in range(nColsToProcess):
-            dx = cols[j]-cols[j+1]
-            dps,dy = getOffset(self.scrImage.img[self.top:self.bottom,cols[j]],
-                               self.scrImage.img[self.top:self.bottom,cols[j+1]],
-                               nu.abs(dx),self.maxAngle)
-            if nu.min(dps) < 0.5: # min is only > 0 when dps has zero range
-                angles.append((nu.arctan2(dy,dx)/nu.pi+.5)%1-.5)
+        img = self.getImgSegment()
+        dx = cols[:nColsToProcess]-cols[1:nColsToProcess+1]
+        if nColsToProcess > 0:
+            dy,valid = getOffsets(img[:,cols[:nColsToProcess]],
+                                  img[:,cols[1:nColsToProcess+1]])
+        else:
+            dy,valid = nu.zeros(0),nu.zeros(0,nu.bool)
+        angles = (nu.arctan2(dy[valid],dx[valid])/nu.pi+.5)%1-.5
         histrange = (-self.maxAngle,self.maxAngle)
         #bins,lims = nu.histogram(angles,bins=self.nbins,range=histrange)
         return nu.histogram(angles,bins=self.nAngleBins,range=histrange)[0]
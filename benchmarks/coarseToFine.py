@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+#    Copyright 2012, Maarten Grachten.
+#
+#    This file is part of CPOMR.
+#
+#    CPOMR is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    CPOMR is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the time and the bar bounding boxes of recognizing pages at full
+resolution and in coarse-to-fine mode (coarse factors 2 and 4). The
+bounding boxes of the coarse-to-fine modes are compared to those of the
+full resolution mode, as the absolute differences of their corner
+coordinates (in pixels).
+
+Usage: python benchmarks/coarseToFine.py [IMAGE ...]
+
+Without IMAGEs, synthetic pages with the size of 600 dpi A4 scans are
+used.
+"""
+
+import sys, os, time, tempfile, shutil, logging, warnings
+import numpy as nu
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+
+factors = (1,2,4)
+
+def recognize(fn,factor):
+    from OMR.scoreImage import ScoreImage
+    t0 = time.time()
+    summary = ScoreImage(fn,coarseFactor=factor).summary
+    return time.time()-t0,summary.barBoundingBoxes
+
+def compare(ref,bbs):
+    """Return the absolute differences of the corner coordinates of two
+    lists of bounding boxes, or None if the bars do not correspond
+    """
+    if len(ref) != len(bbs) or any(len(a) != len(b) for a,b in zip(ref,bbs)):
+        return None
+    if len(ref) == 0:
+        return nu.zeros(0)
+    return nu.abs(nu.concatenate(ref)-nu.concatenate(bbs))
+
+def main(fns):
+    tmpDir = None
+    if len(fns) == 0:
+        from syntheticScore import writePage
+        tmpDir = tempfile.mkdtemp()
+        for k,angle in enumerate((-.4/180.,.2/180.,.6/180.)):
+            fn = os.path.join(tmpDir,'page{0}.png'.format(k))
+            writePage(fn,width=4960,height=7016,nSystems=8,staffLineDistance=40,
+                      lineWidth=5,angle=angle,notesPerSystem=60,seed=k)
+            fns.append(fn)
+    try:
+        print('{0:<16s} {1:>6s} {2:>8s} {3:>6s} {4:>10s} {5:>10s}'.format(
+            'page','factor','time (s)','bars','mean diff','max diff'))
+        for fn in fns:
+            ref = None
+            for factor in factors:
+                t,bbs = recognize(fn,factor)
+                if ref is None:
+                    ref = bbs
+                diff = compare(ref,bbs)
+                if diff is None:
+                    stats = ('bars differ','')
+                elif len(diff) == 0:
+                    stats = ('-','-')
+                else:
+                    stats = ('{0:.2f}'.format(nu.mean(diff)),'{0:d}'.format(int(nu.max(diff))))
+                print('{0:<16s} {1:>6d} {2:>8.2f} {3:>6d} {4:>10s} {5:>10s}'.format(
+                    os.path.basename(fn)[:16],factor,t,len(bbs),*stats))
+    finally:
+        if tmpDir is not None:
+            shutil.rmtree(tmpDir)
+
+if __name__ == '__main__':
+    logging.disable(logging.CRITICAL)
+    warnings.simplefilter('ignore')
+    main(sys.argv[1:])
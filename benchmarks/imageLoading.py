@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+#    Copyright 2012, Maarten Grachten.
+#
+#    This file is part of CPOMR.
+#
+#    CPOMR is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    CPOMR is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the getdata() based page loading with the buffer based
+loading in OMR.imageUtil.getPattern, for L, RGB, RGBA and 1-bit pages.
+
+Usage: python benchmarks/imageLoading.py [width height [repeats]]
+"""
+
+import sys, os, time, tempfile, shutil
+import numpy as nu
+from PIL import Image
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+from OMR.imageUtil import getPattern, avgChannels
+
+def getPatternGetData(filename):
+    """the page loading path as it was before getImageArray"""
+    imageFh = Image.open(filename)
+    s = tuple(reversed(imageFh.size))
+    fimg = nu.array(imageFh.getdata(),nu.uint8).reshape((s[0]*s[1],-1))
+    if imageFh.mode[-1] == 'A':
+        img = avgChannels(fimg[:,:-1])
+    else:
+        img = avgChannels(fimg)
+    return nu.array(img,nu.uint8).reshape(s)
+
+def makePages(outputDir,width,height):
+    rs = nu.random.RandomState(0)
+    grey = nu.where(rs.rand(height,width) < .1,0,255).astype(nu.uint8)
+    base = Image.fromarray(grey)
+    pages = {}
+    for mode in ('L','RGB','RGBA','1'):
+        fn = os.path.join(outputDir,'page-{0}.png'.format(mode))
+        base.convert(mode).save(fn)
+        pages[mode] = fn
+    return pages
+
+def timeIt(f,fn,repeats):
+    times = []
+    for i in range(repeats):
+        t0 = time.time()
+        r = f(fn)
+        times.append(time.time()-t0)
+    return min(times),r
+
+def main(width=2500,height=3300,repeats=3):
+    tmpDir = tempfile.mkdtemp()
+    try:
+        pages = makePages(tmpDir,width,height)
+        print('{0:>5s} {1:>10s} {2:>10s} {3:>8s}'.format('mode','getdata','buffer','speedup'))
+        for mode in ('L','RGB','RGBA','1'):
+            tOld,rOld = timeIt(getPatternGetData,pages[mode],repeats)
+            tNew,rNew = timeIt(lambda fn: getPattern(fn,False,False),pages[mode],repeats)
+            assert nu.all(rOld == rNew), 'Results differ for mode {0}'.format(mode)
+            print('{0:>5s} {1:>9.3f}s {2:>9.3f}s {3:>7.1f}x'.format(mode,tOld,tNew,tOld/tNew))
+    finally:
+        shutil.rmtree(tmpDir)
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
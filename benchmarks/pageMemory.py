@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+#    Copyright 2012, Maarten Grachten.
+#
+#    This file is part of CPOMR.
+#
+#    CPOMR is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    CPOMR is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure the peak resident memory of recognizing (and drawing) a single
+page, when all intermediate images are kept in memory (the default),
+when the deskewed system and bar neighbourhood images are released once
+the bars are found, and when derived images are kept in a scratch file.
+Also report the size of the system and bar neighbourhood images that the
+ScoreImage still holds afterwards (in the scratch file mode, these are
+memory maps). Each measurement runs in a fresh process.
+
+Usage: python benchmarks/pageMemory.py [IMAGE]
+
+Without IMAGE, a synthetic 12-system page is used.
+"""
+
+import sys, os, resource, subprocess, tempfile, shutil, logging, warnings
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+
+modes = (('keep all images',dict()),
+         ('release system images',dict(keepSystemImages=False)),
+         ('scratch file',dict(scratchDir=None)))
+
+def getRetainedImageSize(si):
+    """Return the number of bytes of the arrays held by the systems of si
+    (and by their bar candidates)
+    """
+    from misc.utilities import getDataSize
+    return getDataSize(si.systems,set([id(si)]))
+
+def measure(fn,k):
+    from OMR.scoreImage import ScoreImage
+    options = dict(modes[k][1])
+    if 'scratchDir' in options:
+        options['scratchDir'] = tempfile.gettempdir()
+    si = ScoreImage(fn,**options)
+    nBars = len(si.bars)
+    si.drawAnnotatedScore()
+    # ru_maxrss is in kilobytes on linux
+    return nBars,resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.,getRetainedImageSize(si)/2.**20
+
+def main(fn=None):
+    tmpDir = None
+    if fn is None:
+        from syntheticScore import writePage
+        tmpDir = tempfile.mkdtemp()
+        fn = os.path.join(tmpDir,'orchestral.png')
+        writePage(fn,width=2500,height=3300,nSystems=12,staffLineDistance=18)
+    try:
+        print('{0:<24s} {1:>6s} {2:>14s} {3:>14s}'.format('mode','bars','peak RSS (MB)','retained (MB)'))
+        for k,(name,options) in enumerate(modes):
+            out = subprocess.check_output([sys.executable,os.path.abspath(__file__),
+                                           '--measure',fn,str(k)])
+            nBars,rss,retained = out.split()[-3:]
+            print('{0:<24s} {1:>6s} {2:>14.1f} {3:>14.1f}'.format(name,nBars,float(rss),float(retained)))
+    finally:
+        if tmpDir is not None:
+            shutil.rmtree(tmpDir)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--measure':
+        logging.disable(logging.CRITICAL)
+        warnings.simplefilter('ignore')
+        print('{0} {1} {2}'.format(*measure(sys.argv[2],int(sys.argv[3]))))
+    else:
+        main(*sys.argv[1:])
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+#    Copyright 2012, Maarten Grachten.
+#
+#    This file is part of CPOMR.
+#
+#    CPOMR is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    CPOMR is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare reading the pages of PDF files in process (OMR.pdf) with
+extracting them to PNG files first and loading those (the way of
+extract_pages_from_pdf.sh), for synthetic scanned scores with Flate
+(with and without PNG predictors), DCT (JPEG) and CCITT G4 compressed
+page images. The pages read in process are checked against the pages
+that were written into the PDF files.
+
+Usage: python benchmarks/pdfIngestion.py [nPages [width height]]
+"""
+
+import sys, os, time, zlib, struct, tempfile, shutil
+from cStringIO import StringIO
+import numpy as nu
+from PIL import Image
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+from OMR import pdf
+from OMR.pdf import getPageNames, getPagePattern
+from OMR.imageUtil import getPattern
+from syntheticScore import makePage
+
+def getPNGData(img):
+    """the concatenated IDAT chunks of img saved as PNG"""
+    f = StringIO()
+    Image.fromarray(img).save(f,'PNG')
+    png = f.getvalue()
+    pos,chunks = 8,[]
+    while pos < len(png):
+        length, = struct.unpack('>I',png[pos:pos+4])
+        if png[pos+4:pos+8] == 'IDAT':
+            chunks.append(png[pos+8:pos+8+length])
+        pos += 12+length
+    return ''.join(chunks)
+
+def getG4Data(img):
+    """the CCITT G4 encoded data of img (thresholded), as written by PIL"""
+    f = StringIO()
+    Image.fromarray(img).convert('1').save(f,'TIFF',compression='group4')
+    f.seek(0)
+    tif = Image.open(f)
+    offset,length = tif.tag_v2[273][0],tif.tag_v2[279][0]
+    return f.getvalue()[offset:offset+length]
+
+def encodeImage(img,encoding):
+    """Return the stream dictionary (a string) and data of img as a PDF
+    image XObject
+    """
+    h,w = img.shape
+    d = '/Type /XObject /Subtype /Image /Width {0} /Height {1} /ColorSpace /DeviceGray'.format(w,h)
+    if encoding == 'flate':
+        return d+' /BitsPerComponent 8 /Filter /FlateDecode',zlib.compress(img.tostring())
+    if encoding == 'flate-png':
+        return (d+' /BitsPerComponent 8 /Filter /FlateDecode /DecodeParms '
+                '<< /Predictor 15 /Colors 1 /BitsPerComponent 8 /Columns {0} >>'.format(w)),getPNGData(img)
+    if encoding == 'dct':
+        f = StringIO()
+        Image.fromarray(img).save(f,'JPEG',quality=90)
+        return d+' /BitsPerComponent 8 /Filter /DCTDecode',f.getvalue()
+    if encoding == 'g4':
+        # PIL writes bilevel TIFFs as BlackIsZero, which is BlackIs1 for CCITT data
+        return (d+' /BitsPerComponent 1 /Filter /CCITTFaxDecode /DecodeParms '
+                '<< /K -1 /Columns {0} /Rows {1} /BlackIs1 true >>'.format(w,h)),getG4Data(img)
+
+def writePdf(fn,pages,encoding):
+    """Write a PDF file with one full page image per page"""
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',None]
+    kids = []
+    for img in pages:
+        d,data = encodeImage(img,encoding)
+        objects.append('<< {0} /Length {1} >>\nstream\n{2}\nendstream'.format(d,len(data),data))
+        imgNum = len(objects)
+        content = 'q {0} 0 0 {1} 0 0 cm /Im0 Do Q'.format(img.shape[1]*72/300.,img.shape[0]*72/300.)
+        objects.append('<< /Length {0} >>\nstream\n{1}\nendstream'.format(len(content),content))
+        objects.append('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {0} {1}] /Contents {2} 0 R '
+                       '/Resources << /XObject << /Im0 {3} 0 R >> >> >>'.format(
+                img.shape[1]*72/300.,img.shape[0]*72/300.,len(objects),imgNum))
+        kids.append('{0} 0 R'.format(len(objects)))
+    objects[1] = '<< /Type /Pages /Kids [{0}] /Count {1} >>'.format(' '.join(kids),len(kids))
+    with open(fn,'wb') as f:
+        f.write('%PDF-1.4\n')
+        offsets = []
+        for i,obj in enumerate(objects):
+            offsets.append(f.tell())
+            f.write('{0} 0 obj\n{1}\nendobj\n'.format(i+1,obj))
+        xref = f.tell()
+        f.write('xref\n0 {0}\n0000000000 65535 f \n'.format(len(objects)+1))
+        for offset in offsets:
+            f.write('{0:010d} 00000 n \n'.format(offset))
+        f.write('trailer\n<< /Size {0} /Root 1 0 R >>\nstartxref\n{1}\n%%EOF\n'.format(len(objects)+1,xref))
+
+def readInProcess(fn):
+    # a new PdfFile, as in a fresh process
+    pdf._pdfFiles.clear()
+    return [getPagePattern(name) for name in getPageNames(fn)]
+
+def readViaPNG(fn,tmpDir):
+    pdf._pdfFiles.clear()
+    pages = []
+    for name in getPageNames(fn):
+        png = os.path.join(tmpDir,'page.png')
+        Image.fromarray(getPagePattern(name)).save(png)
+        pages.append(getPattern(png,False,False))
+    return pages
+
+def main(nPages=5,width=2480,height=3508):
+    tmpDir = tempfile.mkdtemp()
+    try:
+        pages = [makePage(width=width,height=height,nSystems=6,staffLineDistance=20,seed=k)
+                 for k in range(nPages)]
+        print('{0:<10s} {1:>9s} {2:>12s} {3:>12s} {4:>10s}'.format(
+            'encoding','size (MB)','in process','via PNG','max error'))
+        for encoding in ('flate','flate-png','dct','g4'):
+            fn = os.path.join(tmpDir,'score-{0}.pdf'.format(encoding))
+            writePdf(fn,pages,encoding)
+            t0 = time.time()
+            read = readInProcess(fn)
+            t1 = time.time()
+            readViaPNG(fn,tmpDir)
+            t2 = time.time()
+            assert len(read) == nPages
+            err = max(nu.max(nu.abs(a.astype(nu.int)-b)) for a,b in zip(read,pages))
+            print('{0:<10s} {1:>9.1f} {2:>11.2f}s {3:>11.2f}s {4:>10d}'.format(
+                encoding,os.path.getsize(fn)/2.**20,t1-t0,t2-t1,err))
+    finally:
+        shutil.rmtree(tmpDir)
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
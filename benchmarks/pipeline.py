@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+#    Copyright 2012, Maarten Grachten.
+#
+#    This file is part of CPOMR.
+#
+#    CPOMR is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    CPOMR is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Time the stages of recognizing synthetic score pages (A4, at one or
+more resolutions) or given images. Each page is recognized in a fresh
+process; for each stage the wall time and the peak resident memory of
+the process after the stage are reported. With --json the results are
+also written to a file, and with --compare the times are compared to
+those of an earlier run (pages are matched by name).
+
+Usage: python benchmarks/pipeline.py [options] [IMAGE ...]
+
+Run with --help for the options.
+"""
+
+import sys, os, time, json, resource, subprocess, tempfile, shutil, platform, logging, warnings, argparse
+import numpy as nu
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+
+# A4, in inches
+pageSize = (8.27,11.69)
+
+def forceDrawing(si):
+    si.drawAnnotatedScore()
+
+stages = (('img',lambda si: si.img),
+          ('vSegments',lambda si: si.vSegments),
+          ('angleHistogram',lambda si: ([vs.angleHistogram for vs in si.vSegments],si.weights)),
+          ('staffLines',lambda si: [vs.staffLines for vs in si.getStaffSegments()]),
+          ('systems',lambda si: si.systems),
+          ('correctedImgSegment',lambda si: [s.correctedImgSegment for s in si.systems]),
+          ('barLineAgents',lambda si: [s.barLineAgents for s in si.systems]),
+          ('barLines',lambda si: [s.barLines for s in si.systems]),
+          ('bars',lambda si: si.bars),
+          ('drawing',forceDrawing))
+
+def getPeakRSS():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+def measure(fn,staffEngine='agents'):
+    """Recognize the page in fn stage by stage, and return the wall time
+    and peak memory (MB) after each stage
+    """
+    from OMR.scoreImage import ScoreImage
+    si = ScoreImage(fn,staffEngine=staffEngine)
+    # the memory taken by the interpreter and the imported modules
+    result = dict(stages=[],startRSS=getPeakRSS())
+    for name,stage in stages:
+        t0 = time.time()
+        stage(si)
+        result['stages'].append(dict(name=name,time=time.time()-t0,peakRSS=getPeakRSS()))
+    result['systems'] = len(si.systems)
+    result['bars'] = len(si.bars)
+    # the columns visited by the staff line tracking (or fitted by the
+    # comb engine), per staff segment
+    result['staffColumns'] = [vs.nColumns for vs in si.getStaffSegments()]
+    return result
+
+def getPageConfig(options,dpi):
+    """Return the makePage arguments of a synthetic page at dpi, where
+    distances in options are in mm
+    """
+    pxPerMm = dpi/25.4
+    sld = int(round(options.staff_distance*pxPerMm))
+    return dict(width=int(pageSize[0]*dpi),height=int(pageSize[1]*dpi),
+                nSystems=options.systems,staffLineDistance=sld,
+                lineWidth=max(1,int(round(sld/7.))),angle=options.angle/180.,
+                barsPerSystem=options.bars,notesPerSystem=options.notes,
+                noise=options.noise,seed=options.seed)
+
+def getVersion():
+    try:
+        with open(os.devnull,'w') as null:
+            return subprocess.check_output(['git','describe','--always','--dirty'],stderr=null,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def runPage(fn,repeats,staffEngine):
+    """Measure fn repeats times, each in a fresh process, and keep the
+    smallest time and peak memory of each stage
+    """
+    best = None
+    for i in range(repeats):
+        out = subprocess.check_output([sys.executable,os.path.abspath(__file__),'--measure',fn,staffEngine])
+        result = json.loads(out.splitlines()[-1])
+        if best is None:
+            best = result
+        else:
+            for b,s in zip(best['stages'],result['stages']):
+                b['time'] = min(b['time'],s['time'])
+                b['peakRSS'] = min(b['peakRSS'],s['peakRSS'])
+    best['total'] = sum(s['time'] for s in best['stages'])
+    return best
+
+def printPage(page,reference=None):
+    print('{0} ({1} systems, {2} bars; {3:.1f} MB before loading)'.format(
+        page['page'],page['systems'],page['bars'],page['startRSS']))
+    if page.get('staffColumns'):
+        print('  staff lines found in {0} columns per segment on average'.format(
+            sum(page['staffColumns'])//len(page['staffColumns'])))
+    header = '  {0:<20s} {1:>9s} {2:>14s}'.format('stage','time (s)','peak RSS (MB)')
+    if reference is not None:
+        header += ' {0:>10s}'.format('vs. ref')
+        refTimes = dict((s['name'],s['time']) for s in reference['stages'])
+    print(header)
+    for s in page['stages']+[dict(name='total',time=page['total'],peakRSS=max(s['peakRSS'] for s in page['stages']))]:
+        line = '  {0:<20s} {1:>9.3f} {2:>14.1f}'.format(s['name'],s['time'],s['peakRSS'])
+        if reference is not None:
+            refTime = reference['total'] if s['name'] == 'total' else refTimes.get(s['name'])
+            if refTime:
+                line += ' {0:>9.2f}x'.format(s['time']/refTime)
+        print(line)
+
+def getParser():
+    parser = argparse.ArgumentParser(description='Time the stages of the recognition pipeline')
+    parser.add_argument('images',metavar='IMAGE',nargs='*',
+                        help='images to recognize, instead of synthetic pages')
+    parser.add_argument('--dpi',type=int,nargs='+',default=[300,600],
+                        help='resolutions of the synthetic pages (default: 300 600)')
+    parser.add_argument('--systems',type=int,default=8,help='systems per page (default: 8)')
+    parser.add_argument('--staff-distance',type=float,default=1.75,metavar='MM',
+                        help='distance between staff lines in mm (default: 1.75)')
+    parser.add_argument('--angle',type=float,default=.3,metavar='DEGREES',
+                        help='skew of the page (default: .3)')
+    parser.add_argument('--noise',type=float,default=0.,
+                        help='proportion of pixels that are flipped (default: 0)')
+    parser.add_argument('--bars',type=int,default=4,help='bars per system (default: 4)')
+    parser.add_argument('--notes',type=int,default=40,help='note heads per system (default: 40)')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--repeat',type=int,default=1,metavar='N',
+                        help='measure each page N times, and keep the best (default: 1)')
+    parser.add_argument('--staff-engine',choices=('agents','comb'),default='agents',
+                        help='how staff lines are found (see ScoreImage; default: agents)')
+    parser.add_argument('--json',metavar='FILE',help='write the results to FILE')
+    parser.add_argument('--compare',metavar='FILE',help='compare the times to those in FILE')
+    return parser
+
+def main(options):
+    reference = {}
+    if options.compare:
+        with open(options.compare) as f:
+            reference = dict((p['page'],p) for p in json.load(f)['pages'])
+    tmpDir = tempfile.mkdtemp()
+    try:
+        pages = [(os.path.basename(fn),fn,None) for fn in options.images]
+        if len(pages) == 0:
+            from syntheticScore import writePage
+            for dpi in options.dpi:
+                config = getPageConfig(options,dpi)
+                fn = os.path.join(tmpDir,'synthetic-{0}dpi.png'.format(dpi))
+                writePage(fn,**config)
+                pages.append((os.path.basename(fn),fn,config))
+        results = []
+        for name,fn,config in pages:
+            page = runPage(fn,options.repeat,options.staff_engine)
+            page['page'] = name
+            page['staffEngine'] = options.staff_engine
+            if config is not None:
+                page['config'] = config
+            printPage(page,reference.get(name))
+            results.append(page)
+    finally:
+        shutil.rmtree(tmpDir)
+    if options.json:
+        with open(options.json,'w') as f:
+            json.dump(dict(version=getVersion(),date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                           python=platform.python_version(),numpy=nu.__version__,
+                           pages=results),f,indent=2)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--measure':
+        logging.disable(logging.CRITICAL)
+        warnings.simplefilter('ignore')
+        print(json.dumps(measure(*sys.argv[2:4])))
+    else:
+        main(getParser().parse_args())
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+#    Copyright 2012, Maarten Grachten.
+#
+#    This file is part of CPOMR.
+#
+#    CPOMR is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    CPOMR is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Generate synthetic score pages: systems of two five-line staffs,
+joined by bar lines, with some note heads, optionally skewed.
+
+Usage: python benchmarks/syntheticScore.py OUTPUT.png [nSystems [seed]]
+"""
+
+import sys
+import numpy as nu
+from PIL import Image
+
+def drawLine(img,y0,x0,x1,angle,width):
+    """draw a (nearly) horizontal line starting at row y0 in the page center,
+    from column x0 to x1, skewed by angle (rad/PI)"""
+    H,W = img.shape
+    cols = nu.arange(int(x0),int(x1))
+    rows = nu.round(y0+(cols-W/2.)*nu.tan(angle*nu.pi)).astype(nu.int)
+    for k in range(int(width)):
+        ok = (rows+k >= 0) & (rows+k < H)
+        img[rows[ok]+k,cols[ok]] = 1
+
+def drawBarLine(img,y0,y1,x,angle,width):
+    """draw a (nearly) vertical line at column x in the page center, from
+    row y0 to y1 (taken at column x), skewed by angle (rad/PI)"""
+    H,W = img.shape
+    t = nu.tan(angle*nu.pi)
+    rows = nu.arange(int(y0+(x-W/2.)*t),int(y1+(x-W/2.)*t))
+    cols = nu.round(x-(rows-y0)*t).astype(nu.int)
+    for k in range(int(width)):
+        ok = (rows >= 0) & (rows < H) & (cols+k < W)
+        img[rows[ok],cols[ok]+k] = 1
+
+def drawNoteHead(img,y,x,sld):
+    ry,rx = .5*sld,.7*sld
+    yy,xx = nu.mgrid[int(y-ry):int(y+ry)+1,int(x-rx):int(x+rx)+1]
+    inside = ((yy-y)/ry)**2+((xx-x)/rx)**2 < 1
+    ok = inside & (yy >= 0) & (yy < img.shape[0]) & (xx >= 0) & (xx < img.shape[1])
+    img[yy[ok],xx[ok]] = 1
+
+def makePage(width=1800,height=2400,nSystems=6,staffLineDistance=20,lineWidth=3,
+             angle=.3/180.,barsPerSystem=4,notesPerSystem=30,noise=0.,seed=0):
+    """
+    Return a synthetic score page as a uint8 array (white background,
+    black ink). angle is the skew of the page in rad/PI, noise is the
+    proportion of pixels that are flipped at random.
+    """
+    rs = nu.random.RandomState(seed)
+    sld = staffLineDistance
+    img = nu.zeros((height,width),nu.uint8)
+    margin = int(.07*width)
+    left,right = margin,width-margin
+    top = int(.06*height)
+    step = (height-2*top)/float(nSystems)
+    for s in range(nSystems):
+        staffTops = [top+s*step,top+s*step+6*sld]
+        for t in staffTops:
+            for k in range(5):
+                drawLine(img,t+k*sld,left,right,angle,lineWidth)
+        for x in nu.linspace(left,right-lineWidth,barsPerSystem+1):
+            drawBarLine(img,staffTops[0],staffTops[1]+4*sld+lineWidth,x,angle,lineWidth+1)
+        for k in range(notesPerSystem):
+            x = rs.randint(left+sld,right-sld)
+            y = staffTops[rs.randint(2)]+rs.randint(0,4*sld)+(x-width/2.)*nu.tan(angle*nu.pi)
+            drawNoteHead(img,y,x,sld)
+    if noise > 0:
+        flip = rs.rand(height,width) < noise
+        img[flip] = 1-img[flip]
+    return (255*(1-img)).astype(nu.uint8)
+
+def writePage(fn,mode='L',**kwargs):
+    Image.fromarray(makePage(**kwargs)).convert(mode).save(fn)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    kwargs = {}
+    if len(sys.argv) > 2:
+        kwargs['nSystems'] = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        kwargs['seed'] = int(sys.argv[3])
+    writePage(sys.argv[1],**kwargs)
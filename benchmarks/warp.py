@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+#    Copyright 2012, Maarten Grachten.
+#
+#    This file is part of CPOMR.
+#
+#    CPOMR is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    CPOMR is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with CPOMR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the time of deskewing the systems of a page with the former
+implementation of getAntiAliasedImg (full coordinate grids, float64)
+and with getDerotatedImg, and count the pixels in which the results
+differ.
+
+Usage: python benchmarks/warp.py [IMAGE]
+
+Without IMAGE, a synthetic 12-system page is used.
+"""
+
+import sys, os, time, tempfile, shutil, logging, warnings
+import numpy as nu
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+
+def referenceAntiAliasedImg(img,xx,yy):
+    from OMR.imageUtil import trimCoordinates
+    xx,yy = trimCoordinates(img.shape,xx,yy,margin=1)
+    xf = nu.floor(xx).astype(nu.int)
+    xc = nu.ceil(xx).astype(nu.int)
+    yf = nu.floor(yy).astype(nu.int)
+    yc = nu.ceil(yy).astype(nu.int)
+    wxc = xx%1
+    wxf = 1-wxc
+    wyc = yy%1
+    wyf = 1-wyc
+    return (((wxf+wyf)*img[xf,yf] +
+             (wxf+wyc)*img[xf,yc] +
+             (wxc+wyf)*img[xc,yf] +
+             (wxc+wyc)*img[xc,yc])/4.0).astype(nu.uint8)
+
+def reference(system):
+    halfSystemWidth = int((system.getSystemWidth()-1)/2)
+    xx,yy = nu.mgrid[0:system.getSystemHeight(),-halfSystemWidth:halfSystemWidth]
+    yy += system.getLowerMidLocal()[1]
+    xxr,yyr = system.rotator.derotate(xx,yy)
+    return referenceAntiAliasedImg(system.scrImage.img,xxr,yyr)
+
+def derotated(system):
+    from OMR.imageUtil import getDerotatedImg
+    halfSystemWidth = int((system.getSystemWidth()-1)/2)
+    rows = nu.arange(0,system.getSystemHeight())
+    cols = nu.arange(-halfSystemWidth,halfSystemWidth)+system.getLowerMidLocal()[1]
+    return getDerotatedImg(system.scrImage.img,system.rotator,rows,cols)
+
+def timeIt(f,systems,repeat=3):
+    best = None
+    for k in range(repeat):
+        t0 = time.time()
+        results = [f(s) for s in systems]
+        t = time.time()-t0
+        best = t if best is None else min(best,t)
+    return best,results
+
+def main(fn=None):
+    from OMR.scoreImage import ScoreImage
+    tmpDir = None
+    if fn is None:
+        from syntheticScore import writePage
+        tmpDir = tempfile.mkdtemp()
+        fn = os.path.join(tmpDir,'orchestral.png')
+        writePage(fn,width=2500,height=3300,nSystems=12,staffLineDistance=18)
+    try:
+        systems = ScoreImage(fn).systems
+        tRef,ref = timeIt(reference,systems)
+        tNew,new = timeIt(derotated,systems)
+        nPixels = sum(r.size for r in ref)
+        nDiff = sum(nu.sum(r != n) for r,n in zip(ref,new))
+        maxDiff = max(nu.max(nu.abs(r.astype(nu.int)-n)) for r,n in zip(ref,new))
+        print('{0} systems, {1} pixels'.format(len(systems),nPixels))
+        print('{0:<20s} {1:>8.3f} s'.format('full grids',tRef))
+        print('{0:<20s} {1:>8.3f} s'.format('getDerotatedImg',tNew))
+        print('differing pixels: {0} (max. difference {1})'.format(nDiff,maxDiff))
+    finally:
+        if tmpDir is not None:
+            shutil.rmtree(tmpDir)
+
+if __name__ == '__main__':
+    logging.disable(logging.CRITICAL)
+    warnings.simplefilter('ignore')
+    main(*sys.argv[1:])
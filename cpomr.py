@@ -4,7 +4,9 @@ import sys, os, logging, argparse
 import numpy as nu
 import pickle
 from OMR.scoreImage import ScoreImage
-from OMR.piece import Piece
+from OMR.piece import Piece, closePool, findPieces, readManifest, writeBatchOutput
+from OMR.pdf import isPdf
+from OMR.resultCache import ResultCache
 
 logging.basicConfig(format='%(levelname)s: [%(name)s] %(message)s',level=logging.INFO)
 
@@ -12,7 +14,7 @@ class CommandLineHandler(object):
     def __init__(self):
         self.parser = argparse.ArgumentParser(description='Detect music notation in sheet music')
         self.parser.add_argument('filenames', metavar='FILENAME', type=str, nargs='+',
-                                 help='Image filename; multiple filenames will be treated as ' \
+                                 help='Image or PDF filename; multiple filenames will be treated as ' \
                                      'the consecutive pages of a single piece')
         self.parser.add_argument('--output-dir','-o', metavar='OUTPUTDIR', 
                                  type=str,default='/tmp/',
@@ -29,12 +31,102 @@ class CommandLineHandler(object):
                                  help='Write bar bounding box coordinates to a text file ' \
                                      '(default: %(default)s);  output ' \
                                      'will be in txt format, and stored in OUTPUTDIR')
+        self.parser.add_argument('--batch','-B',action='store_true',
+                                 dest='batch',default=False,
+                                 help='Process many pieces at once (default: %(default)s); ' \
+                                     'each FILENAME is either a directory, in which every ' \
+                                     'directory containing images is a piece, or a manifest ' \
+                                     'file, with one piece per line, given as a name followed ' \
+                                     'by the page filenames, or a PDF file. The output of each piece is ' \
+                                     'stored in a subdirectory of OUTPUTDIR named after the piece')
+        self.parser.add_argument('--jobs','-j',metavar='N',type=int,
+                                 dest='jobs',default=None,
+                                 help='Number of pages to process in parallel ' \
+                                     '(default: number of CPUs)')
+        self.parser.add_argument('--cache-dir',metavar='CACHEDIR',type=str,
+                                 dest='cacheDir',default=None,
+                                 help='Store recognition results in CACHEDIR, and reuse them ' \
+                                     'for images that have been processed before with the ' \
+                                     'same parameters and program version (default: no caching)')
+        self.parser.add_argument('--cache-size',metavar='MB',type=float,
+                                 dest='cacheSize',default=100,
+                                 help='Maximal size of the result cache in megabytes; the least ' \
+                                     'recently used results are removed first (default: %(default)s)')
+        self.parser.add_argument('--scratch-dir',metavar='SCRATCHDIR',type=str,
+                                 dest='scratchDir',default=None,
+                                 help='Keep intermediate images in temporary files in SCRATCHDIR, ' \
+                                     'rather than in memory (default: in memory)')
+        self.parser.add_argument('--coarse-factor',metavar='F',type=int,
+                                 dest='coarseFactor',default=1,
+                                 help='Recognize pages on images downsampled by a factor F, ' \
+                                     'refining the bar bounding boxes at full resolution; ' \
+                                     'this is faster for high resolution (e.g. 600 dpi) scans ' \
+                                     '(default: %(default)s)')
+        self.parser.add_argument('--profile',action='store_true',
+                                 dest='profile',default=False,
+                                 help='Record the compute time, number of computations and ' \
+                                     'result size of each stage of the recognition, and write ' \
+                                     'a report per page and per piece to OUTPUTDIR ' \
+                                     '(default: %(default)s)')
+        self.parser.add_argument('--system-jobs',metavar='N',type=int,
+                                 dest='systemJobs',default=1,
+                                 help='Number of systems of a page whose bar lines are searched ' \
+                                     'in parallel processes; this speeds up large pages when there ' \
+                                     'are more CPUs than pages, but is only possible when pages are ' \
+                                     'processed one at a time (-j 1) (default: %(default)s)')
+        self.parser.add_argument('--segment-jobs',metavar='N',type=int,
+                                 dest='segmentJobs',default=1,
+                                 help='Number of staff segments of a page whose staff lines are ' \
+                                     'tracked in parallel processes; this is only possible when ' \
+                                     'pages are processed one at a time (-j 1) ' \
+                                     '(default: %(default)s)')
+        self.parser.add_argument('--page-width',metavar='W',type=int,
+                                 dest='pageWidth',default=None,
+                                 help='Resize the page images (of image or PDF files) to a ' \
+                                     'width of W pixels; downscaling is done while decoding ' \
+                                     'the images where possible (default: no resizing)')
+        self.parser.add_argument('--no-triage',action='store_false',
+                                 dest='triage',default=True,
+                                 help='Recognize every page fully; by default, pages that show no ' \
+                                     'sign of staffs in a quick test (blank pages, title pages, ' \
+                                     'text pages) are skipped, and listed as skipped in the pages ' \
+                                     'file written with -b')
+        self.parser.add_argument('--staff-engine',choices=('agents','comb'),
+                                 dest='staffEngine',default='agents',
+                                 help='How staff lines are found: by tracking them column by ' \
+                                     'column with agents, or by matching a comb of five lines ' \
+                                     'to the row projection of each staff segment, which is ' \
+                                     'faster; segments where the comb does not fit well are ' \
+                                     'tracked with agents (default: %(default)s)')
         self.args = self.parser.parse_args()
         self.canWrite = False
         self.draw = self.args.draw
         self.outputDir = self.args.outputDir
         self.barCoordinates = self.args.barCoordinates
         self.filenames = self.args.filenames
+        self.jobs = self.args.jobs
+        self.batch = self.args.batch
+        self.profile = self.args.profile
+        self.cacheDir = self.args.cacheDir
+        self.cacheSize = self.args.cacheSize
+        self.pageOptions = dict(scratchDir=self.args.scratchDir,
+                                coarseFactor=self.args.coarseFactor,
+                                systemJobs=self.args.systemJobs,
+                                segmentJobs=self.args.segmentJobs,
+                                pageWidth=self.args.pageWidth,
+                                triage=self.args.triage,
+                                staffEngine=self.args.staffEngine)
+
+    def getPieces(self):
+        pieces = []
+        for fn in self.filenames:
+            if os.path.isdir(fn):
+                pieces.extend(findPieces(fn))
+            elif isPdf(fn):
+                pieces.append(Piece([fn],name=os.path.splitext(os.path.basename(fn))[0]))
+            else:
+                pieces.extend(readManifest(fn))
+        return pieces
 
 if __name__ == '__main__':
     clh = CommandLineHandler()
@@ -52,15 +144,38 @@ if __name__ == '__main__':
         except:
             log.error('Can not write to output directory {0}'.format(clh.outputDir))
 
-    piece = Piece(clh.filenames)
-    if clh.draw:
-        if clh.canWrite:
-            piece.drawAnnotatedScores(clh.outputDir)
-        else:
-            log.warn('Will not draw annotated scores (output directory not writeable)')
-    if clh.barCoordinates:
-        if clh.canWrite:
-            piece.writeBarCoordinates(clh.outputDir)
-        else:
-            log.warn('Will not write bar coordinates (output directory not writeable)')
+    draw = clh.draw
+    if draw and not clh.canWrite:
+        log.warn('Will not draw annotated scores (output directory not writeable)')
+        draw = False
+    barCoordinates = clh.barCoordinates
+    if barCoordinates and not clh.canWrite:
+        log.warn('Will not write bar coordinates (output directory not writeable)')
+        barCoordinates = False
+
+    profile = clh.profile
+    if profile and not clh.canWrite:
+        log.warn('Will not write profile (output directory not writeable)')
+        profile = False
 
+    cache = None
+    if clh.cacheDir:
+        cache = ResultCache(clh.cacheDir,int(clh.cacheSize*2**20))
+
+    if draw or barCoordinates or profile:
+        try:
+            if clh.batch:
+                failed = writeBatchOutput(clh.getPieces(),clh.outputDir,draw=draw,
+                                          barCoordinates=barCoordinates,jobs=clh.jobs,cache=cache,
+                                          pageOptions=clh.pageOptions,profile=profile)
+            else:
+                piece = Piece(clh.filenames,jobs=clh.jobs,cache=cache,pageOptions=clh.pageOptions,
+                              profile=profile)
+                failed = piece.writeOutput(clh.outputDir,draw=draw,barCoordinates=barCoordinates)
+        finally:
+            closePool()
+        if len(failed) > 0:
+            log.error('{0} page(s) could not be processed:'.format(len(failed)))
+            for page in failed:
+                log.error('\t{0}: {1}'.format(page.fn,page.error))
+            sys.exit(1)
@@ -17,7 +17,7 @@
 #    You should have received a copy of the GNU General Public License
 #    along with mg_python_modules.  If not, see <http://www.gnu.org/licenses/>.
 
-import re,sys,os
+import re,sys,os,time,types,threading
 from numpy import array,size,std
 import numpy as nu
 import subprocess
@@ -55,13 +55,127 @@ except:
     sys.stderr.write('Warning, could not import scipy not all functionality is available')
 
 
+def getDataSize(value,seen=None):
+    """
+    Return the number of bytes of the numpy arrays in value, including
+    those in (nested) lists, tuples, dicts and attributes of objects.
+    Values whose id is in seen (a set that is updated) are not counted,
+    so shared values are counted once, and the owner of value can be
+    excluded by putting its id in seen.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    if isinstance(value,nu.ndarray):
+        seen.add(id(value))
+        return value.nbytes
+    if isinstance(value,(list,tuple)):
+        seen.add(id(value))
+        return sum(getDataSize(v,seen) for v in value)
+    if isinstance(value,dict):
+        seen.add(id(value))
+        return sum(getDataSize(v,seen) for v in value.values())
+    if hasattr(value,'__dict__') and not isinstance(value,(type,types.ModuleType,types.FunctionType,
+                                                           types.MethodType)):
+        seen.add(id(value))
+        return getDataSize(value.__dict__,seen)
+    return 0
+
+class PropertyProfile(object):
+    """
+    Records, for each (class name, property name), how often cachedProperties
+    are computed, the total time of the computations, the time excluding
+    the computation of other cachedProperties (own time), and the total
+    size of the results (see getDataSize). Computations in other threads
+    or processes are not subtracted from the own time. Nothing is
+    recorded unless enabled is True.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.records = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def _nested(self):
+        "the time spent in nested computations, per computation in progress (in this thread)"
+        if not hasattr(self.local,'nested'):
+            self.local.nested = []
+        return self.local.nested
+
+    def start(self):
+        """Clear the records and start recording
+        """
+        self.records = {}
+        self.local = threading.local()
+        self.enabled = True
+
+    def stop(self):
+        """Stop recording, and return the records
+        """
+        self.enabled = False
+        return self.records
+
+    def add(self,records):
+        """Add records (e.g. those of a worker process) to the records
+        """
+        with self.lock:
+            self.records = mergeProfiles([self.records,records])
+
+    def compute(self,func,obj,name):
+        self._nested.append(0.)
+        t0 = time.time()
+        try:
+            value = func(obj)
+        finally:
+            t = time.time()-t0
+            nested = self._nested.pop()
+            if len(self._nested) > 0:
+                self._nested[-1] += t
+        # what value refers to of obj is not part of the result
+        size = getDataSize(value,set([id(obj)]))
+        with self.lock:
+            record = self.records.setdefault((type(obj).__name__,name),[0,0.,0.,0])
+            record[0] += 1
+            record[1] += t
+            record[2] += t-nested
+            record[3] += size
+        return value
+
+propertyProfile = PropertyProfile()
+
+def mergeProfiles(profiles):
+    """Return the sum of the records of several PropertyProfiles
+    """
+    merged = {}
+    for records in profiles:
+        for key,record in records.items():
+            m = merged.setdefault(key,[0,0.,0.,0])
+            for i,x in enumerate(record):
+                m[i] += x
+    return merged
+
+def formatProfile(records,title=None):
+    """Return the records of a PropertyProfile as a table (a string),
+    sorted by own time
+    """
+    lines = [] if title is None else ['# {0}'.format(title)]
+    lines.append('{0:<40s} {1:>6s} {2:>10s} {3:>10s} {4:>10s}'.format(
+        'property','calls','total (s)','own (s)','size (MB)'))
+    for (cls,name),(n,t,own,size) in sorted(records.items(),key=lambda x: -x[1][2]):
+        lines.append('{0:<40s} {1:>6d} {2:>10.3f} {3:>10.3f} {4:>10.2f}'.format(
+            cls+'.'+name,n,t,own,size/2.**20))
+    return '\n'.join(lines)+'\n'
+
 def cachedProperty (func ,name =None ):
     """
     cachedProperty(func, name=None) -> a descriptor
     This decorator implements an object's property which is computed
     the first time it is accessed, and which value is then stored in
     the object's __dict__ for later use. If the attribute is deleted,
-    the value will be recomputed the next time it is accessed.
+    the value will be recomputed the next time it is accessed. The
+    computations are recorded by propertyProfile, if it is enabled.
 
     Usage:
 
@@ -78,7 +192,10 @@ def cachedProperty (func ,name =None ):
         try :
             return self.__dict__[name]
         except KeyError :
-            self.__dict__[name] = func(self)
+            if propertyProfile.enabled:
+                self.__dict__[name] = propertyProfile.compute(func,self,name)
+            else:
+                self.__dict__[name] = func(self)
             return self.__dict__[name]
 
     @wraps(func)
@@ -174,14 +291,18 @@ def indir(dirname,f):
 class Result(object):
     def __init__(self,v):
         self.v = v
-    def get(self):
+    def get(self,timeout=None):
         return self.v
+    def ready(self):
+        return True
 
 class FakePool(object):
     def __init__(self):
         pass
     def map(self,f,a):
         return map(f,a)
+    def imap_unordered(self,f,a,chunksize=1):
+        return itertools.imap(f,a)
     def apply_async(self,f,args=(),kwargs={},callback=None):
         if callback:
             callback(f(*args,**kwargs))